@@ -0,0 +1,65 @@
+"""
+Benchmark the compiled field mapping plans against the per cell
+dictionary lookups that the converters used to do.
+
+  python benchmarks/bench_mapping.py [records]
+"""
+
+import os, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import ide.mapping
+import moodle_ide_to_csv
+import mahara_ide_to_csv
+
+HEADER = ['mlepSmsPersonId', 'mlepFirstName', 'mlepLastName', 'mlepEmail', 'mlepRole', 'mlepGroupMembership', 'password']
+
+
+def records(count):
+    return [{'mlepSmsPersonId': str(100000 + i),
+             'mlepFirstName': 'First' + str(i),
+             'mlepLastName': 'Last' + str(i),
+             'mlepEmail': 'user' + str(i) + '@hogwarts.school.nz',
+             'mlepRole': 'Student',
+             'mlepGroupMembership': '9A#Maths 101#Science',
+             'password': ''} for i in xrange(count)]
+
+
+def per_cell(users, user_fields, field_map):
+    user_cols = [field for field in user_fields if field_map[field] in HEADER]
+    for user in users:
+        user['mlepUsername'] = user['mlepSmsPersonId'] + '@hogwarts.school.nz'
+        user['password'] = 'secret'
+        row = [user[field_map[field]] for field in user_cols]
+
+
+def compiled(users, user_fields, field_map):
+    computed = {'mlepUsername': lambda user: user['mlepSmsPersonId'] + '@hogwarts.school.nz',
+                'password': lambda user: 'secret'}
+    project = ide.mapping.plan(user_fields, field_map, HEADER, computed).project
+    for user in users:
+        row = project(user)
+
+
+def best(func, users, user_fields, field_map, repeat=5):
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        func(users, user_fields, field_map)
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main():
+    count = 100000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    users = records(count)
+    for (name, module) in [('moodle', moodle_ide_to_csv), ('mahara', mahara_ide_to_csv)]:
+        old = best(per_cell, users, module.USER_FIELDS, module.FIELD_MAP)
+        new = best(compiled, users, module.USER_FIELDS, module.FIELD_MAP)
+        print '%s: per cell %d rows/s, compiled %d rows/s (%.1fx)' % (name, count / old, count / new, old / new)
+
+
+if __name__ == "__main__":
+    main()
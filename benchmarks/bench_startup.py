@@ -0,0 +1,102 @@
+"""
+Benchmark the start up time of each IDE tools subcommand, to track
+regressions in what gets imported.
+
+  python benchmarks/bench_startup.py [runs]
+
+Each subcommand is run with --help in a fresh interpreter, and the best
+wall clock time is reported, along with the slowest imports of each
+subcommand.  Those come from -X importtime where the interpreter has it
+(Python 3.7 and later), and otherwise from timing __import__ - which gives
+cumulative times only, and counts a module under the name it was imported
+by.  A subcommand that exits with an error fails the benchmark.
+"""
+
+from __future__ import print_function
+import os, sys, time
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+CLI = os.path.join(ROOT, 'ide_tools.py')
+COMMANDS = ['moodle-csv', 'mahara-csv', 'mahara-sync']
+TOP_IMPORTS = 5
+
+# runs a script as __main__, reporting each first import in the format of
+# -X importtime, for interpreters without it
+IMPORT_HOOK = r"""
+import sys, time, atexit, runpy
+try:
+    import __builtin__ as builtins
+except ImportError:
+    import builtins
+_import = builtins.__import__
+_times = []
+def _timed(name, *args, **kwargs):
+    if name in sys.modules:
+        return _import(name, *args, **kwargs)
+    start = time.time()
+    try:
+        return _import(name, *args, **kwargs)
+    finally:
+        _times.append((time.time() - start, name))
+def _report():
+    for (elapsed, name) in _times:
+        sys.stderr.write('import time: - | %d | %s\n' % (elapsed * 1000000, name))
+atexit.register(_report)
+builtins.__import__ = _timed
+sys.argv = sys.argv[1:]
+runpy.run_path(sys.argv[0], run_name='__main__')
+"""
+
+
+def run(args):
+    devnull = open(os.devnull, 'w')
+    try:
+        start = time.time()
+        status = subprocess.call([sys.executable] + args, stdout=devnull, stderr=devnull, cwd=ROOT)
+        elapsed = time.time() - start
+    finally:
+        devnull.close()
+    if status != 0:
+        sys.exit('%s exited with status %d' % (' '.join(args), status))
+    return elapsed
+
+
+def import_times(command):
+    """
+    (cumulative microseconds, module) for the slowest imports of a subcommand.
+    """
+    if sys.version_info >= (3, 7):
+        args = ['-X', 'importtime', CLI, command, '--help']
+    else:
+        args = ['-c', IMPORT_HOOK, CLI, command, '--help']
+    proc = subprocess.Popen([sys.executable] + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=ROOT)
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+        sys.exit('%s exited with status %d:\n%s' % (' '.join(args[-3:]), proc.returncode, err.decode('utf-8', 'replace')))
+    times = []
+    for line in err.decode('utf-8', 'replace').splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        fields = line[len('import time:'):].split('|')
+        times.append((int(fields[1]), fields[2].rstrip()))
+    times.sort(reverse=True)
+    return times[:TOP_IMPORTS]
+
+
+def main():
+    runs = 10
+    if len(sys.argv) > 1:
+        runs = int(sys.argv[1])
+    baseline = min([run(['-c', 'pass']) for i in range(runs)])
+    print('interpreter: %.1fms' % (baseline * 1000))
+    for command in COMMANDS:
+        best = min([run([CLI, command, '--help']) for i in range(runs)])
+        print('%s: %.1fms (%.1fms over the interpreter)' % (command, best * 1000, (best - baseline) * 1000))
+        for (cumulative, module) in import_times(command):
+            print('    %8.1fms %s' % (cumulative / 1000.0, module))
+
+
+if __name__ == "__main__":
+    main()
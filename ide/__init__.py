@@ -27,7 +27,32 @@ class csvfile(object):
     """
 
     @classmethod
-    def read(cls, ide_file):
+    def header(cls, ide_file):
+        """
+        The header fields of an IDE file, and whether any record follows -
+        read without parsing the records, for checking a file up front.
+        Both are empty/False for an empty file.
+        """
+        f = open(ide_file, 'rb')
+        fields = []
+        try:
+            for line in f:
+                # skip blank, comment and timestamp lines as read() does
+                if re.match('^$', line) or re.match('^#', line) or re.match('^\d{4}-\d\d-\d\d \d\d:\d\d:\d\d$', line):
+                    continue
+                if fields:
+                    return fields, True
+                fields = csv.reader([line.strip()], delimiter=',', quotechar='"').next()
+        finally:
+            f.close()
+        return fields, False
+
+    @classmethod
+    def read(cls, ide_file, duplicates=None):
+        """
+        Read the records of an IDE file - with an ide.duplicates.keyindex,
+        only one record per person is kept, as its policy decides.
+        """
         csv_file = []
 
         # preprocess the file to remove blank lines and comments
@@ -58,7 +83,16 @@ class csvfile(object):
             item = {}
             for (name, value) in items:
                 item[name] = value.strip()
-            csv_file.append(item)
+            if duplicates is None:
+                csv_file.append(item)
+                continue
+            position = duplicates.place(item, len(csv_file))
+            if position is None:
+                continue
+            if position == len(csv_file):
+                csv_file.append(item)
+            else:
+                csv_file[position] = item
             #print(item)
         
         return csv_file
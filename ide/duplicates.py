@@ -0,0 +1,93 @@
+"""
+Duplicate detection for IDE records as they are read
+
+Each record's mlepSmsPersonId (case folded, as the usernames derived from
+it are) is reduced to a compact hashed key, and kept with the position of
+its record, so duplicates are found in the one pass of the reader:
+
+    duplicates = ide.duplicates.keyindex('first')
+    records = ide.csvfile.read('ide.csv', duplicates)
+    logging.info(duplicates.report())
+
+The policy decides which record of a person is kept - 'first', 'last',
+or 'fail' which raises DuplicateException at the first duplicate.
+"""
+
+import hashlib
+import logging
+
+POLICIES = ['first', 'last', 'fail']
+DEFAULT_POLICY = 'last'
+
+# bytes of the digest kept per key
+KEY_SIZE = 8
+
+# duplicates listed in the report
+REPORT_MAX = 10
+
+
+class DuplicateException(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+def key(value):
+    """
+    The compact hashed key of a person id or username.
+    """
+    return hashlib.md5(value.lower()).digest()[:KEY_SIZE]
+
+
+class keyindex(object):
+    """
+    Index of the person ids seen, and the positions of their records
+    """
+
+    def __init__(self, policy=DEFAULT_POLICY):
+        if not policy in POLICIES:
+            raise ValueError("duplicate policy must be one of " + ", ".join(POLICIES) + ": " + str(policy))
+        self.policy = policy
+        self.positions = {}
+        self.count = 0
+        # (kind, value, first record number, duplicate record number)
+        self.duplicates = []
+
+    def place(self, record, position):
+        """
+        Where the next record goes in the list of records read so far -
+        position to append it, an earlier position to replace the record of
+        the same person, or None to drop it.
+        """
+        self.count += 1
+        person = record.get('mlepSmsPersonId', '')
+        k = key(person)
+        if not k in self.positions:
+            self.positions[k] = (position, self.count)
+            return position
+        earlier, number = self.positions[k]
+        self.found('person', person, number)
+        if self.policy == 'first':
+            return None
+        self.positions[k] = (earlier, self.count)
+        return earlier
+
+    def found(self, kind, value, number):
+        message = "duplicate %s %s in record %d - previously in record %d" % (kind, value, self.count, number)
+        if self.policy == 'fail':
+            raise DuplicateException(message)
+        logging.warning(message + " - %s wins" % self.policy)
+        self.duplicates.append((kind, value, number, self.count))
+
+    def report(self):
+        """
+        Summary of the duplicates found, for the run log.
+        """
+        if not self.duplicates:
+            return "duplicates: none in %d records" % self.count
+        listed = ", ".join(["%s %s (records %d, %d)" % d for d in self.duplicates[:REPORT_MAX]])
+        if len(self.duplicates) > REPORT_MAX:
+            listed += ", ..."
+        return "duplicates: %d in %d records, %s wins - %s" % (len(self.duplicates), self.count, self.policy, listed)
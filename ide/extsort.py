@@ -0,0 +1,112 @@
+"""
+External sort for outputs too big to hold in memory
+
+Items (tuples of strings and numbers) are held in memory up to a limit,
+then sorted and spilled to a temporary run file on disk.  Iterating over
+the sorter merges the runs, and whatever is still in memory, in one
+streaming pass.  So that the open run files stay few however small the
+limit, every MERGE_WIDTH runs of the same size are merged into one run -
+each item is rewritten once per level of those merges.
+
+    memberships = ide.extsort.sorter(limit=100000)
+    for ...:
+        memberships.add((group, username, role))
+    for (group, username, role) in memberships:
+        ...
+    memberships.close()
+"""
+
+import heapq
+import marshal
+import tempfile
+import logging
+
+# items held in memory before a run is spilled to disk
+DEFAULT_LIMIT = 200000
+
+# runs of the same level merged into one run of the next level
+MERGE_WIDTH = 16
+
+
+def read_run(f):
+    """
+    Stream the items back out of a run file.
+    """
+    f.seek(0)
+    while True:
+        try:
+            yield marshal.load(f)
+        except EOFError:
+            return
+
+
+class sorter(object):
+    """
+    Sort items with bounded memory - a limit of 0 never spills
+    """
+
+    def __init__(self, limit=DEFAULT_LIMIT, tmpdir=None):
+        self.limit = limit
+        self.tmpdir = tmpdir
+        self.items = []
+        self.runs = []
+        # the merge level of each run - 0 for a spill
+        self.levels = []
+        self.count = 0
+
+    def add(self, item):
+        self.items.append(item)
+        self.count += 1
+        if self.limit and len(self.items) >= self.limit:
+            self.spill()
+
+    def spill(self):
+        """
+        Write the items in memory out as a sorted run.
+        """
+        if not self.items:
+            return
+        self.items.sort()
+        self.runs.append(self.write_run(self.items))
+        self.levels.append(0)
+        logging.debug("spilled sorted run %d of %d items" % (len(self.runs), len(self.items)))
+        self.items = []
+        # levels only fall along the list of runs, so a full level is at the end
+        while len(self.levels) >= MERGE_WIDTH and self.levels[-MERGE_WIDTH] == self.levels[-1]:
+            self.merge_runs()
+
+    def write_run(self, items):
+        f = tempfile.TemporaryFile(dir=self.tmpdir)
+        for item in items:
+            marshal.dump(item, f)
+        f.flush()
+        return f
+
+    def merge_runs(self):
+        """
+        Merge the last MERGE_WIDTH runs into one run of the next level.
+        """
+        runs = self.runs[-MERGE_WIDTH:]
+        level = self.levels[-1] + 1
+        f = self.write_run(heapq.merge(*[read_run(run) for run in runs]))
+        for run in runs:
+            run.close()
+        self.runs[-MERGE_WIDTH:] = [f]
+        self.levels[-MERGE_WIDTH:] = [level]
+        logging.debug("merged %d sorted runs into a run of level %d" % (len(runs), level))
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        self.items.sort()
+        if not self.runs:
+            return iter(self.items)
+        return heapq.merge(self.items, *[read_run(f) for f in self.runs])
+
+    def close(self):
+        for f in self.runs:
+            f.close()
+        self.runs = []
+        self.levels = []
+        self.items = []
@@ -0,0 +1,67 @@
+"""
+Compiled field mapping plans
+
+A plan maps IDE records onto a target CSV schema.  It is compiled once for
+a header into a row projector function, so projecting each record into a
+row costs one subscript per cell, plus any computed columns, instead of two
+dictionary lookups per cell and mutating the record.
+
+    plan = ide.mapping.plan(USER_FIELDS, FIELD_MAP, header,
+                            computed={'password': lambda record: ...})
+    rows = [plan.columns] + [plan(record) for record in records]
+
+See benchmarks/bench_mapping.py for the rows per second gained.
+"""
+
+import time, random
+
+
+def account_fields(options):
+    """
+    The computed IDE fields the converters share - the username, and the
+    password given by the options (empty, default or generated).
+    """
+    computed = {'mlepUsername': lambda user: user['mlepSmsPersonId'] + '@' + options.school_domain}
+    if options.emptypassword:
+        computed['password'] = lambda user: ''
+    elif options.password:
+        computed['password'] = lambda user: options.password
+    elif options.genpassword:
+        computed['password'] = lambda user: 'pass' + str(random.random()) + str(int(time.time()))
+    return computed
+
+
+class plan(object):
+    """
+    Row projector for one target schema and one IDE header
+      target_fields - the output columns, in order
+      field_map - output column to IDE field name
+      header - the IDE field names available (including any computed ones)
+      computed - IDE field name to a function of the record, used in place
+                 of the value in the record
+    A target column is output when its IDE field is in the header.
+    """
+
+    def __init__(self, target_fields, field_map, header, computed=None):
+        computed = computed or {}
+        header = set(header)
+        self.columns = [field for field in target_fields if field_map[field] in header]
+        self.sources = [field_map[field] for field in self.columns]
+
+        # generate the projector in the same way as collections.namedtuple -
+        # plain cells are constant subscripts, computed cells are calls
+        namespace = {}
+        cells = []
+        for source in self.sources:
+            if source in computed:
+                name = '_compute%d' % len(namespace)
+                namespace[name] = computed[source]
+                cells.append('%s(record)' % name)
+            else:
+                cells.append('record[%r]' % source)
+        code = 'def project(record):\n    return [%s]\n' % ', '.join(cells)
+        exec code in namespace
+        self.project = namespace['project']
+
+    def __call__(self, record):
+        return self.project(record)
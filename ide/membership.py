@@ -0,0 +1,120 @@
+"""
+Group membership and role parsing
+
+Every record's mlepGroupMembership is split on '#', spaces replaced with
+'_', and its mlepRole appended as a group, and the role is classified as
+teacher or not.  Whole classes share the same membership string, so the
+results are memoised in a bounded LRU cache keyed on the raw strings.
+
+    groups, teacher = ide.membership.parse_record(record)
+
+groups is an immutable tuple of interned group names, and the same tuple
+is handed back for every record that shares the membership and role.  The
+cache is locked, as the targets of a multi-target run share it.
+"""
+
+import threading
+
+# distinct (membership, role) pairs held
+CACHE_SIZE = 4096
+
+
+class lrucache(object):
+    """
+    Least recently used cache of the results of a function - the entries
+    are links [prev, next, key, value] in a circular list off root.  The
+    function is called outside the lock, as functools.lru_cache does.
+    """
+
+    def __init__(self, function, maxsize=CACHE_SIZE):
+        self.function = function
+        self.maxsize = maxsize
+        self.map = {}
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, *key):
+        root = self.root
+        self.lock.acquire()
+        try:
+            link = self.map.get(key)
+            if link is not None:
+                # move to the most recently used end
+                prev, next = link[0], link[1]
+                prev[1] = next
+                next[0] = prev
+                last = root[0]
+                last[1] = root[0] = link
+                link[0] = last
+                link[1] = root
+                self.hits += 1
+                return link[3]
+            self.misses += 1
+        finally:
+            self.lock.release()
+
+        value = self.function(*key)
+        self.lock.acquire()
+        try:
+            if key in self.map:
+                # another thread got there first
+                return value
+            if len(self.map) >= self.maxsize:
+                # evict the least recently used
+                oldest = root[1]
+                root[1] = oldest[1]
+                oldest[1][0] = root
+                del self.map[oldest[2]]
+            last = root[0]
+            link = [last, root, key, value]
+            last[1] = root[0] = self.map[key] = link
+        finally:
+            self.lock.release()
+        return value
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.map.clear()
+            self.root[:] = [self.root, self.root, None, None]
+            self.hits = 0
+            self.misses = 0
+        finally:
+            self.lock.release()
+
+    def report(self):
+        lookups = self.hits + self.misses
+        rate = 0.0
+        if lookups:
+            rate = 100.0 * self.hits / lookups
+        return "%d lookups, %d hits (%.1f%%), %d cached" % (lookups, self.hits, rate, len(self.map))
+
+
+def _parse(membership, role):
+    groups = []
+    if membership:
+        groups = [intern(g.replace(' ', '_')) for g in membership.split('#')]
+    if role:
+        groups.append(intern(role))
+    return tuple(groups), role.startswith('Teach')
+
+
+# (groups, teacher) for the raw mlepGroupMembership and mlepRole strings
+parse = lrucache(_parse)
+
+
+def parse_record(record):
+    """
+    (groups, teacher) for an IDE record.
+    """
+    return parse(record.get('mlepGroupMembership', ''), record.get('mlepRole', ''))
+
+
+def report():
+    """
+    The cache hit rate, for the run summary.
+    """
+    return "membership cache: " + parse.report()
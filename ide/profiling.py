@@ -0,0 +1,261 @@
+"""
+Profiling of the phases of a run
+
+With --profile=DIR, each major phase of a tool (IDE read, transform,
+remote fetch, diff, write/apply) is run under cProfile, and where the
+interpreter has tracemalloc (Python 3.4 and later) its allocations are
+traced too.  Phases run one after the other - starting a phase ends the
+one before:
+
+    ide.profiling.enable(options.profile)
+    ide.profiling.phase('read')
+    ...
+    ide.profiling.phase('transform')
+    ...
+
+For each phase NN-name.pstats is written to the directory, and with
+tracemalloc NN-name.alloc lists the top allocating lines.  phases.txt
+holds the wall and CPU time, and the memory high water mark, of each
+phase.  Only the thread that enabled profiling is profiled - the
+concurrent page fetches and targets are timed, but not broken down.  Work
+handed to another thread can be profiled on its own, as the importer does
+with the IDE read that runs alongside the remote fetch:
+
+    read = ide.profiling.profiled('read', get_csv_file)
+
+Its pstats are written as for a phase, and phases.txt gives its wall time,
+but not CPU or memory, as those are only measured for the whole process.
+
+Two profile runs are compared with:
+
+    python ide_tools.py profile-compare OLD_DIR NEW_DIR
+"""
+
+from __future__ import print_function
+import os, sys, time
+import threading
+import logging
+
+# lines listed in the allocation reports and comparisons
+TOP = 20
+SUMMARY_FILE = 'phases.txt'
+
+_active = None
+
+
+class profiler(object):
+    """
+    Profiles a sequence of phases into a directory
+    """
+
+    def __init__(self, directory, top=TOP):
+        import cProfile
+        try:
+            import tracemalloc
+        except ImportError:
+            tracemalloc = None
+        self.cProfile = cProfile
+        self.tracemalloc = tracemalloc
+        self.directory = directory
+        self.top = top
+        self.thread = threading.current_thread()
+        self.count = 0
+        self.current = None
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        if not tracemalloc:
+            logging.info("tracemalloc is not available - memory is reported as the process high water mark only")
+
+    def phase(self, name):
+        """
+        End the current phase, and start profiling the next.
+        """
+        self.end()
+        prefix = self.prefix(name)
+        if self.tracemalloc:
+            self.tracemalloc.start()
+        profile = self.cProfile.Profile()
+        self.current = (prefix, time.time(), cpu_time(), profile)
+        profile.enable()
+
+    def end(self):
+        """
+        End the current phase, and write out its reports.
+        """
+        if not self.current:
+            return
+        prefix, wall, cpu, profile = self.current
+        profile.disable()
+        self.current = None
+        wall = time.time() - wall
+        cpu = cpu_time() - cpu
+        profile.dump_stats(os.path.join(self.directory, prefix + '.pstats'))
+        traced = ''
+        if self.tracemalloc:
+            snapshot = self.tracemalloc.take_snapshot()
+            size, peak = self.tracemalloc.get_traced_memory()
+            self.tracemalloc.stop()
+            traced = ' traced_peak_kb=%d' % (peak / 1024)
+            f = open(os.path.join(self.directory, prefix + '.alloc'), 'w')
+            for stat in snapshot.statistics('lineno')[:self.top]:
+                print(str(stat), file=f)
+            f.close()
+        self.summary('%s wall=%.3f cpu=%.3f maxrss_kb=%d%s' % (prefix, wall, cpu, max_rss(), traced))
+        logging.info("profiled phase %s: %.3fs wall, %.3fs cpu" % (prefix, wall, cpu))
+
+    def prefix(self, name):
+        self.lock.acquire()
+        try:
+            self.count += 1
+            return '%02d-%s' % (self.count, name)
+        finally:
+            self.lock.release()
+
+    def summary(self, line):
+        self.lock.acquire()
+        try:
+            f = open(os.path.join(self.directory, SUMMARY_FILE), 'a')
+            print(line, file=f)
+            f.close()
+        finally:
+            self.lock.release()
+
+    def profiled(self, name, function):
+        """
+        function wrapped to run under its own profile, in whatever thread
+        calls it.
+        """
+        def run(*args):
+            prefix = self.prefix(name)
+            profile = self.cProfile.Profile()
+            started = time.time()
+            try:
+                return profile.runcall(function, *args)
+            finally:
+                wall = time.time() - started
+                profile.dump_stats(os.path.join(self.directory, prefix + '.pstats'))
+                self.summary('%s wall=%.3f concurrent' % (prefix, wall))
+                logging.info("profiled %s: %.3fs wall" % (prefix, wall))
+        return run
+
+
+def cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def max_rss():
+    """
+    The memory high water mark of the process in KB - 0 where unknown.
+    """
+    try:
+        import resource
+    except ImportError:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss = rss / 1024
+    return rss
+
+
+def enable(directory):
+    """
+    Profile the phases of this run into directory - a false directory
+    leaves profiling off.  The last phase is ended when the process exits.
+    """
+    global _active
+    if not directory:
+        return
+    import atexit
+    _active = profiler(directory)
+    atexit.register(_active.end)
+    logging.info("profiling phases into: " + directory)
+
+
+def phase(name):
+    """
+    Start the named phase, ending the one before - only when profiling is
+    enabled, and only in the thread that enabled it.
+    """
+    if _active and threading.current_thread() is _active.thread:
+        _active.phase(name)
+
+
+def end():
+    if _active and threading.current_thread() is _active.thread:
+        _active.end()
+
+
+def profiled(name, function):
+    """
+    function wrapped to be profiled as the named step when profiling is
+    enabled - for work run in another thread, alongside the phases.
+    """
+    if not _active:
+        return function
+    return _active.profiled(name, function)
+
+
+def load(directory):
+    """
+    {phase: {(file, function): (calls, own time, cumulative time)}} for a
+    profile directory.  The code file is reduced to its base name, and line
+    numbers are dropped, so that the runs of two versions of the code match.
+    """
+    import pstats
+    phases = {}
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith('.pstats'):
+            continue
+        functions = {}
+        stats = pstats.Stats(os.path.join(directory, name))
+        for ((filename, line, function), (cc, nc, tt, ct, callers)) in stats.stats.items():
+            key = (os.path.basename(filename), function)
+            calls, own, cumulative = functions.get(key, (0, 0.0, 0.0))
+            functions[key] = (calls + nc, own + tt, cumulative + ct)
+        phases[name[:-len('.pstats')]] = functions
+    return phases
+
+
+def compare(old, new, top=TOP, out=sys.stdout):
+    """
+    Report the functions of each phase whose own time grew the most between
+    two profile directories.
+    """
+    old_phases = load(old)
+    new_phases = load(new)
+    for name in sorted(set(old_phases.keys()) | set(new_phases.keys())):
+        if not name in old_phases or not name in new_phases:
+            print('%s: only in %s' % (name, name in old_phases and old or new), file=out)
+            continue
+        before, after = old_phases[name], new_phases[name]
+        old_total = sum([v[1] for v in before.values()])
+        new_total = sum([v[1] for v in after.values()])
+        print('%s: %.3fs -> %.3fs (%+.3fs)' % (name, old_total, new_total, new_total - old_total), file=out)
+        deltas = []
+        for key in set(before.keys()) | set(after.keys()):
+            calls0, own0, cum0 = before.get(key, (0, 0.0, 0.0))
+            calls1, own1, cum1 = after.get(key, (0, 0.0, 0.0))
+            deltas.append((own1 - own0, key, own0, own1, calls0, calls1, cum1 - cum0))
+        deltas.sort(reverse=True)
+        for (delta, (filename, function), own0, own1, calls0, calls1, cumulative) in deltas[:top]:
+            if delta <= 0:
+                break
+            print('    %+8.3fs own %8.3fs -> %8.3fs  %+8.3fs cumulative  calls %d -> %d  %s:%s'
+                  % (delta, own0, own1, cumulative, calls0, calls1, filename, function), file=out)
+
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog [options] OLD_DIR NEW_DIR")
+    parser.add_option("--top", dest="top", default=TOP, type="int",
+                          help="Functions listed per phase", metavar="TOP")
+    (options, args) = parser.parse_args()
+    if len(args) != 2:
+        parser.error("two profile directories are required")
+    for directory in args:
+        if not os.path.isdir(directory):
+            parser.error("profile directory not found: " + directory)
+    compare(args[0], args[1], options.top)
+    sys.exit(0)
@@ -0,0 +1,56 @@
+"""
+JSON serialisation for web service payloads
+
+Uses the fastest JSON backend that is installed - ujson, then simplejson,
+then the standard library json - and can encode big list payloads (the
+users or groups of a web service call) a chunk at a time.
+"""
+
+try:
+    import ujson as backend
+except ImportError:
+    try:
+        import simplejson as backend
+    except ImportError:
+        import json as backend
+
+BACKEND = backend.__name__
+
+# list items encoded per chunk
+CHUNK_SIZE = 500
+
+
+def dumps(obj):
+    return backend.dumps(obj)
+
+
+def loads(data):
+    return backend.loads(data)
+
+
+def iterencode(payload, chunk_size=CHUNK_SIZE):
+    """
+    Encode a payload as a sequence of string chunks.  The list values of a
+    dictionary payload are encoded chunk_size items at a time, so only one
+    chunk of encoded items needs to be held at once.
+    """
+    if not isinstance(payload, dict):
+        yield dumps(payload)
+        return
+
+    separator = '{'
+    for (key, value) in payload.iteritems():
+        if not isinstance(value, list):
+            yield separator + dumps(key) + ':' + dumps(value)
+        else:
+            yield separator + dumps(key) + ':['
+            for i in xrange(0, len(value), chunk_size):
+                chunk = dumps(value[i:i + chunk_size])[1:-1]
+                if i:
+                    chunk = ',' + chunk
+                yield chunk
+            yield ']'
+        separator = ','
+    if separator == '{':
+        yield '{'
+    yield '}'
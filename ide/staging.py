@@ -0,0 +1,297 @@
+"""
+SQLite staging store for IDE snapshots
+
+Each IDE file loaded becomes a snapshot - persons, groups and memberships
+keyed by the snapshot id - so that change sets between any two snapshots
+(or between an IDE snapshot and the state fetched from a remote system)
+can be computed with indexed SQL joins.
+
+    store = ide.staging.staging('ide-staging.db')
+    new = store.load(ide.csvfile.read('ide.csv'), source='ide.csv')
+    old = store.snapshot_before(time.time() - 7 * 86400)
+    create, update, delete = store.group_changes(old, new)
+
+Snapshots of remote images are labelled with a source starting 'remote ',
+and are only kept for the run that loads them.  Only the newest
+--keepsnapshots IDE snapshots are kept - older ones are pruned as each new
+one is loaded.
+"""
+
+import time
+import logging
+
+from ide.membership import parse_record
+
+# source label prefix of the snapshots of remote images
+REMOTE_SOURCE = 'remote '
+
+# IDE snapshots kept by stage() - 0 keeps them all
+KEEP_SNAPSHOTS = 7
+
+# rows per executemany() call
+BATCH_SIZE = 1000
+
+# seconds a connection waits for another writer to finish
+LOCK_TIMEOUT = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    source TEXT,
+    loaded INTEGER
+);
+CREATE TABLE IF NOT EXISTS persons (
+    snapshot INTEGER NOT NULL,
+    pkey TEXT NOT NULL,
+    person_id TEXT,
+    firstname TEXT,
+    lastname TEXT,
+    email TEXT,
+    role TEXT,
+    PRIMARY KEY (snapshot, pkey)
+);
+CREATE TABLE IF NOT EXISTS groups (
+    snapshot INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    PRIMARY KEY (snapshot, name)
+);
+CREATE TABLE IF NOT EXISTS memberships (
+    snapshot INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    pkey TEXT NOT NULL,
+    role TEXT,
+    PRIMARY KEY (snapshot, name, pkey)
+);
+CREATE INDEX IF NOT EXISTS memberships_pkey ON memberships (snapshot, pkey);
+CREATE INDEX IF NOT EXISTS snapshots_loaded ON snapshots (loaded);
+"""
+
+
+class StagingException(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+def batches(rows, size=BATCH_SIZE):
+    """
+    Chop an iterable of rows into lists of at most size rows.
+    """
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class staging(object):
+    """
+    Snapshot store - the database is created on first use.  Concurrent
+    writers each need their own connection, opened with create False once
+    the schema exists, as creating it under another writer fails.
+    """
+
+    def __init__(self, db_file=':memory:', create=True):
+        try:
+            import sqlite3
+        except ImportError:
+            raise StagingException('the SQLite staging store requires the sqlite3 module')
+        self.db_file = db_file
+        self.db = sqlite3.connect(db_file, timeout=LOCK_TIMEOUT)
+        self.db.text_factory = str
+        if create:
+            self.db.executescript(SCHEMA)
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def _insert(self, table, columns, rows):
+        sql = 'INSERT OR REPLACE INTO %s (%s) VALUES (%s)' % (table, ', '.join(columns), ', '.join(['?'] * len(columns)))
+        count = 0
+        for batch in batches(rows):
+            self.db.executemany(sql, batch)
+            count += len(batch)
+        return count
+
+    def load_snapshot(self, persons=(), groups=(), memberships=(), source=''):
+        """
+        Bulk load a snapshot in one transaction, and return its id.
+          persons - (pkey, person_id, firstname, lastname, email, role)
+          groups - group names
+          memberships - (name, pkey, role)
+        Duplicate keys are resolved last-wins.
+        """
+        try:
+            cursor = self.db.execute('INSERT INTO snapshots (source, loaded) VALUES (?, ?)', (source, int(time.time())))
+            snapshot = cursor.lastrowid
+            n_persons = self._insert('persons', ['snapshot', 'pkey', 'person_id', 'firstname', 'lastname', 'email', 'role'],
+                                     ((snapshot,) + tuple(p) for p in persons))
+            n_groups = self._insert('groups', ['snapshot', 'name'], ((snapshot, g) for g in groups))
+            n_members = self._insert('memberships', ['snapshot', 'name', 'pkey', 'role'],
+                                     ((snapshot,) + tuple(m) for m in memberships))
+            self.db.commit()
+        except:
+            self.db.rollback()
+            raise
+        logging.info("staged snapshot %d (%s): %d persons, %d groups, %d memberships" % (snapshot, source, n_persons, n_groups, n_members))
+        return snapshot
+
+    def load(self, records, source=''):
+        """
+        Bulk load IDE records (as returned by ide.csvfile.read) as a new snapshot.
+        Persons are keyed on the lower cased mlepSmsPersonId.
+        """
+        persons = []
+        groups = set()
+        memberships = []
+        for record in records:
+            pkey = record['mlepSmsPersonId'].lower()
+            role = record.get('mlepRole', '')
+            persons.append((pkey, record['mlepSmsPersonId'], record.get('mlepFirstName', ''),
+                            record.get('mlepLastName', ''), record.get('mlepEmail', ''), role))
+            for group in parse_record(record)[0]:
+                groups.add(group)
+                memberships.append((group, pkey, role))
+        return self.load_snapshot(persons, groups, memberships, source)
+
+    def drop(self, snapshot):
+        """
+        Remove a snapshot and everything keyed on it.
+        """
+        for table in ['memberships', 'groups', 'persons']:
+            self.db.execute('DELETE FROM %s WHERE snapshot = ?' % table, (snapshot,))
+        self.db.execute('DELETE FROM snapshots WHERE id = ?', (snapshot,))
+        self.db.commit()
+
+    def snapshots(self):
+        """
+        List of (id, source, loaded) for every snapshot, oldest first.
+        """
+        return self.db.execute('SELECT id, source, loaded FROM snapshots ORDER BY id').fetchall()
+
+    def snapshot_before(self, when, source=None):
+        """
+        The id of the latest snapshot loaded at or before the unix time when,
+        optionally restricted to one source - None if there is none.
+        """
+        sql = 'SELECT MAX(id) FROM snapshots WHERE loaded <= ?'
+        args = [int(when)]
+        if source is not None:
+            sql += ' AND source = ?'
+            args.append(source)
+        return self.db.execute(sql, args).fetchone()[0]
+
+    def latest_ide_snapshot(self):
+        """
+        The id of the latest IDE snapshot, whatever file it was loaded from -
+        None if there is none.
+        """
+        sql = 'SELECT MAX(id) FROM snapshots WHERE source NOT LIKE ?'
+        return self.db.execute(sql, (REMOTE_SOURCE + '%',)).fetchone()[0]
+
+    def prune(self, keep=KEEP_SNAPSHOTS):
+        """
+        Drop all but the newest keep IDE snapshots, and any remote images
+        left behind by an interrupted run - keep 0 keeps everything.
+        Returns the number of snapshots dropped.
+        """
+        if not keep:
+            return 0
+        snapshots = self.snapshots()
+        ide_snapshots = [row[0] for row in snapshots if not row[1].startswith(REMOTE_SOURCE)]
+        old = ide_snapshots[:-keep]
+        if old:
+            # and remote images older than the oldest IDE snapshot kept
+            oldest = ide_snapshots[-keep:][0]
+            old += [row[0] for row in snapshots if row[1].startswith(REMOTE_SOURCE) and row[0] < oldest]
+        for snapshot in old:
+            self.drop(snapshot)
+        if old:
+            logging.info("pruned %d old snapshots" % len(old))
+        return len(old)
+
+    def _changes(self, table, key, old, new):
+        added = 'SELECT n.%(key)s FROM %(table)s n LEFT JOIN %(table)s o ON o.snapshot = ? AND o.%(key)s = n.%(key)s WHERE n.snapshot = ? AND o.%(key)s IS NULL' % {'table': table, 'key': key}
+        common = 'SELECT n.%(key)s FROM %(table)s n JOIN %(table)s o ON o.snapshot = ? AND o.%(key)s = n.%(key)s WHERE n.snapshot = ?' % {'table': table, 'key': key}
+        create = [r[0] for r in self.db.execute(added, (old, new))]
+        update = [r[0] for r in self.db.execute(common, (old, new))]
+        delete = [r[0] for r in self.db.execute(added, (new, old))]
+        return create, update, delete
+
+    def person_changes(self, old, new):
+        """
+        (create, update, delete) lists of person keys going from snapshot old
+        to snapshot new - update is every person present in both.
+        """
+        return self._changes('persons', 'pkey', old, new)
+
+    def group_changes(self, old, new):
+        """
+        (create, update, delete) lists of group names going from snapshot old
+        to snapshot new - update is every group present in both.
+        """
+        return self._changes('groups', 'name', old, new)
+
+    def modified_persons(self, old, new):
+        """
+        Keys of persons present in both snapshots whose details differ.
+        """
+        sql = """SELECT n.pkey FROM persons n JOIN persons o ON o.snapshot = ? AND o.pkey = n.pkey
+                 WHERE n.snapshot = ? AND (n.firstname IS NOT o.firstname OR n.lastname IS NOT o.lastname
+                                           OR n.email IS NOT o.email OR n.role IS NOT o.role)"""
+        return [r[0] for r in self.db.execute(sql, (old, new))]
+
+    def membership_changes(self, old, new):
+        """
+        (added, removed) lists of (group name, person key) going from snapshot
+        old to snapshot new.
+        """
+        sql = """SELECT n.name, n.pkey FROM memberships n LEFT JOIN memberships o
+                 ON o.snapshot = ? AND o.name = n.name AND o.pkey = n.pkey
+                 WHERE n.snapshot = ? AND o.pkey IS NULL"""
+        added = self.db.execute(sql, (old, new)).fetchall()
+        removed = self.db.execute(sql, (new, old)).fetchall()
+        return added, removed
+
+    def changed_groups(self, old, new):
+        """
+        Names of groups whose membership differs between the two snapshots.
+        """
+        added, removed = self.membership_changes(old, new)
+        return sorted(set([name for (name, pkey) in added + removed]))
+
+    def group_members(self, snapshot):
+        """
+        Dictionary of group name to the list of member person keys.
+        """
+        result = {}
+        for (name, pkey) in self.db.execute('SELECT name, pkey FROM memberships WHERE snapshot = ? ORDER BY name', (snapshot,)):
+            result.setdefault(name, []).append(pkey)
+        return result
+
+
+def stage(db_file, records, source, keep=KEEP_SNAPSHOTS):
+    """
+    Load records as a new snapshot, and log what changed since the previous
+    IDE snapshot - from whichever file, as drops are often named by date.
+    Only the newest keep IDE snapshots are kept.  Returns (store, previous,
+    snapshot) - previous is None on the first run.
+    """
+    store = staging(db_file)
+    previous = store.latest_ide_snapshot()
+    snapshot = store.load(records, source=source)
+    store.prune(keep)
+    if previous is not None:
+        create, update, delete = store.person_changes(previous, snapshot)
+        modified = store.modified_persons(previous, snapshot)
+        logging.info("persons since snapshot %d - new: %d changed: %d gone: %d" % (previous, len(create), len(modified), len(delete)))
+        create, update, delete = store.group_changes(previous, snapshot)
+        changed = store.changed_groups(previous, snapshot)
+        logging.info("groups since snapshot %d - new: %d changed membership: %d gone: %d" % (previous, len(create), len(changed), len(delete)))
+    return store, previous, snapshot
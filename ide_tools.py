@@ -0,0 +1,74 @@
+"""
+This program is a single entry point for the IDE tools, with a
+subcommand for each of them.
+
+SYNOPSIS:
+
+  python ide_tools.py --help
+
+  python ide_tools.py moodle-csv --file=ide.csv --domain=hogwarts.school.nz -u -c -e -a admin
+  python ide_tools.py mahara-csv --file=ide.csv --domain=hogwarts.school.nz -u -g -a admin
+  python ide_tools.py mahara-sync --file=ide.csv --maharaurl=http://mahara.hogwarts.school.nz --consumerkey=<consumer key> --consumersecret=<consumer secret> --domain=hogwarts.school.nz -c -u -d -g
+  python ide_tools.py profile-compare profile.old profile.new
+
+The options of each subcommand are those of the matching program - see
+python ide_tools.py <subcommand> --help
+
+Each program is only imported when its subcommand is run, so running
+dozens of schools from a shell loop only pays the start up cost of the
+tool that is used - the OAuth libraries are not loaded for the CSV
+conversions.  See benchmarks/bench_startup.py.
+
+Copyright (C) Piers Harding 2011 and beyond, All rights reserved
+
+ide_tools.py is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation; either
+version 2 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Lesser General Public License for more details.
+
+"""
+
+from __future__ import print_function
+import os, sys
+
+# subcommand: (module, description)
+COMMANDS = {
+    'moodle-csv': ('moodle_ide_to_csv', 'Transform an IDE file into the Moodle user and course upload files'),
+    'mahara-csv': ('mahara_ide_to_csv', 'Transform an IDE file into the Mahara user and group upload files'),
+    'mahara-sync': ('mahara_ide_importer', 'Synchronise an IDE file with Mahara via Web Services'),
+    'profile-compare': ('ide.profiling', 'Compare the phase profiles of two --profile runs'),
+}
+
+
+def usage(out):
+    print('usage: ' + os.path.basename(sys.argv[0]) + ' <subcommand> [options]', file=out)
+    print('', file=out)
+    print('subcommands:', file=out)
+    for name in sorted(COMMANDS.keys()):
+        print('  %-16s %s' % (name, COMMANDS[name][1]), file=out)
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] in ('-h', '--help'):
+        usage(sys.stdout)
+        sys.exit(0)
+
+    command = sys.argv[1]
+    if not command in COMMANDS:
+        print('unknown subcommand: ' + command, file=sys.stderr)
+        usage(sys.stderr)
+        sys.exit(1)
+
+    # load the subsystem only now, and hand it the rest of the command line
+    module = __import__(COMMANDS[command][0], fromlist=['main'])
+    sys.argv = [sys.argv[0] + ' ' + command] + sys.argv[2:]
+    module.main()
+
+# ------ Good Ol' main ------
+if __name__ == "__main__":
+    main()
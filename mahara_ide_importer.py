@@ -10,6 +10,40 @@ execute import:
 
   python mahara_ide_importer.py --file=ide.csv --maharaurl=http://mahara.hogwarts.school.nz --consumerkey=<consumer key> --consumersecret=<consumer secret> --domain=hogwarts.school.nz -c -u -d -g
 
+run as a daemon, processing each new IDE file dropped into a directory:
+
+  python mahara_ide_importer.py --watch=/var/spool/ide --maharaurl=http://mahara.hogwarts.school.nz --consumerkey=<consumer key> --consumersecret=<consumer secret> --domain=hogwarts.school.nz -c -u -d -g
+
+The drop directory is polled, and a file is only processed once it has
+stopped changing (--settle seconds).  The Mahara users and groups are kept
+in memory between drops, and fetched afresh every --refresh seconds.
+
+synchronise one IDE file to several Mahara instances concurrently:
+
+  python mahara_ide_importer.py --file=ide.csv --domain=hogwarts.school.nz -c -u -d -g --target=http://mahara.hogwarts.school.nz,<consumer key>,<consumer secret> --target=http://staging.hogwarts.school.nz,<consumer key>,<consumer secret>,oauth_token/staging.oauth
+
+plan the changes, review them, and apply them later without re-reading the
+IDE file - the plan is only applied if the institution still matches, it
+is no older than --maxage seconds, and the remote users and groups have not
+changed since the plan was made.  --noverify skips refetching them for that
+last check, but only for plans that delete nothing:
+
+  python mahara_ide_importer.py --file=ide.csv ... --domain=hogwarts.school.nz --plan=changes.plan
+  python mahara_ide_importer.py --apply=changes.plan ... -c -u -d -g
+
+For big institutions, the existing users and groups can be fetched in pages
+(offset/limit) several at a time - --pagesize=500 --fetchthreads=4.
+
+The IDE file is parsed while the Mahara context, users and groups are
+fetched, so the run waits only on the slowest of them before the diff.
+
+A person repeated in the IDE file is reported as it is read, and only one
+of their records used - --duplicates=first|last|fail (last by default).
+A new user whose username is already taken in Mahara stops the run, unless
+--skiptaken is given to leave that user out and carry on.
+
+--profile=DIR profiles each phase of the run (fetch, diff, apply) into
+DIR, and the IDE read that runs alongside the fetch - see ide/profiling.py.
 
 
 It provides options for create/update/delete of user accounts, and 
@@ -59,24 +93,34 @@ Lesser General Public License for more details.
 
 from __future__ import print_function
 import os, sys, re, time, random
-import oauth2 as oauth
-import urllib, cgi
+import fnmatch, hashlib
+import threading, copy
+import zlib
 import json
+import oauth2 as oauth
 import ide
+import ide.profiling
+import ide.duplicates
+from ide import serializer
+from ide.membership import parse_record
 from optparse import OptionParser, SUPPRESS_HELP
 import logging
 
 DEFAULT_AUTH = 'internal'
+PLAN_VERSION = 1
+# the remote user fields that a plan depends on
+USER_COMPARE_FIELDS = ['username', 'firstname', 'lastname', 'email', 'auth', 'institution', 'studentid', 'preferredname']
 TOKEN_DIR = 'oauth_token'
 TOKEN_FILE = TOKEN_DIR + '/mahara.oauth'
-if not os.path.isdir(TOKEN_DIR):
-    os.mkdir(TOKEN_DIR)
 
 
 def write_token_file(filename, oauth_token, oauth_token_secret):
     """
     Write a token file to hold the oauth token and oauth token secret.
     """
+    token_dir = os.path.dirname(filename)
+    if token_dir and not os.path.isdir(token_dir):
+        os.makedirs(token_dir)
     oauth_file = open(filename, 'w')
     print(oauth_token, file=oauth_file)
     print(oauth_token_secret, file=oauth_file)
@@ -93,19 +137,74 @@ def read_token_file(filename):
     return f.readline().strip(), f.readline().strip()
 
 
+def encode_body(content, compress=False):
+    """
+    Encode a request payload - a chunk at a time, so that when compressing,
+    the whole uncompressed body is never held in memory.  Returns the
+    uncompressed length, and the body to send.
+    """
+    length = 0
+    parts = []
+    if compress:
+        # gzip framing
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in serializer.iterencode(content):
+        length += len(chunk)
+        if compress:
+            chunk = compressor.compress(chunk)
+        parts.append(chunk)
+    if compress:
+        parts.append(compressor.flush())
+    return length, ''.join(parts)
+
+
+class TrafficClient(oauth.Client):
+    """
+    OAuth client that counts the response bytes read off the wire - httplib2
+    decompresses gzip responses before handing them back.
+    """
+    def __init__(self, consumer, token=None):
+        oauth.Client.__init__(self, consumer, token)
+        self.wire_bytes = 0
+
+    def _conn_request(self, conn, request_uri, method, body, headers):
+        getresponse = conn.getresponse
+        def counted_response():
+            response = getresponse()
+            read = response.read
+            def counted_read(*args):
+                data = read(*args)
+                self.wire_bytes += len(data)
+                return data
+            response.read = counted_read
+            return response
+        conn.getresponse = counted_response
+        try:
+            return oauth.Client._conn_request(self, conn, request_uri, method, body, headers)
+        finally:
+            # connections are cached by httplib2
+            del conn.getresponse
+
+
 class MaharaProxy:
     def __init__(self, options):
         self.options = options
         self.consumer = oauth.Consumer(key=self.options.consumer_key, secret=self.options.consumer_secret)
-        oauth_token, oauth_token_secret = read_token_file(TOKEN_FILE)
+        oauth_token, oauth_token_secret = read_token_file(self.options.token_file)
         self.oauth_token = oauth_token
         self.oauth_token_secret = oauth_token_secret
+        # bytes before and after compression
+        self.traffic = {'calls': 0, 'request': 0, 'request_wire': 0, 'response': 0, 'response_wire': 0}
+        self.traffic_lock = threading.Lock()
+        self.compress_requests = self.options.compress_requests == 'always'
 
     def is_authorised(self):
         return self.oauth_token
 
     def authorise(self):
         if not self.is_authorised():
+            # only needed for the first authorisation
+            import urllib, cgi
             #oauth_callback=oob
             request_token_url = self.options.mahara_url + "/webservice/oauthv1.php/request_token"
             client = oauth.Client(self.consumer)
@@ -126,7 +225,7 @@ class MaharaProxy:
             response, content = client.request(self.options.mahara_url + '/webservice/oauthv1.php/access_token', 'POST')
             parsed_content = dict(cgi.parse_qsl(content))
             print(parsed_content)
-            write_token_file(TOKEN_FILE, parsed_content['oauth_token'], parsed_content['oauth_token_secret'])
+            write_token_file(self.options.token_file, parsed_content['oauth_token'], parsed_content['oauth_token_secret'])
             self.oauth_token, self.oauth_token_secret = parsed_content['oauth_token'], parsed_content['oauth_token_secret']
 
     def call_mahara(self, content):
@@ -134,19 +233,142 @@ class MaharaProxy:
         access_token = oauth.Token(self.oauth_token, self.oauth_token_secret)
         print(access_token)
 
-        client = oauth.Client(self.consumer, access_token)
-        response = client.request(self.options.mahara_url + '/webservice/rest/server.php?alt=json', method='POST', body=json.dumps(content), headers={'Content-Type': 'application/jsonrequest'})
-        response = json.loads(response[1])
+        headers = {'Content-Type': 'application/jsonrequest', 'Accept-Encoding': 'gzip'}
+        length, wire_body = encode_body(content, self.compress_requests)
+        if self.compress_requests:
+            headers['Content-Encoding'] = 'gzip'
+
+        client = TrafficClient(self.consumer, access_token)
+        response, data = client.request(self.options.mahara_url + '/webservice/rest/server.php?alt=json', method='POST', body=wire_body, headers=headers)
+        # a server that takes compressed request bodies says so
+        if self.options.compress_requests == 'auto' and 'gzip' in response.get('accept-encoding', ''):
+            self.compress_requests = True
+        self.count_traffic(calls=1, request=length, request_wire=len(wire_body), response=len(data), response_wire=client.wire_bytes)
+        response = serializer.loads(data)
         if response and 'exception' in response and response['exception'] == 'OAuthException2':
-            print("There was an OAuth authentication problem - try removing " + TOKEN_DIR + " dir", response)
-            logging.error("There was an OAuth authentication problem - try removing " + TOKEN_DIR + " dir")
+            print("There was an OAuth authentication problem - try removing " + self.options.token_file, response)
+            logging.error("There was an OAuth authentication problem - try removing " + self.options.token_file)
             sys.exit(1)
 
         return response
 
+    def count_traffic(self, **counts):
+        self.traffic_lock.acquire()
+        try:
+            for (name, count) in counts.iteritems():
+                self.traffic[name] += count
+        finally:
+            self.traffic_lock.release()
+
+    def traffic_report(self):
+        return "%(calls)d calls, requests %(request)d bytes (%(request_wire)d on the wire), responses %(response)d bytes (%(response_wire)d on the wire)" % self.traffic
+
+    def fetch_pages(self, content, offsets, page_size):
+        """
+        Fetch the pages at the given offsets concurrently - one thread each.
+        """
+        pages = [None] * len(offsets)
+        errors = []
+        def fetch(i):
+            try:
+                parameters = dict(content)
+                parameters.update({'offset': offsets[i], 'limit': page_size})
+                pages[i] = self.call_mahara(parameters)
+            except:
+                errors.append(sys.exc_info())
+        threads = [threading.Thread(target=fetch, args=(i,)) for i in range(len(offsets))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        return pages
+
+    def call_mahara_paged(self, content):
+        """
+        Fetch a list in pages of options.page_size records, options.fetch_threads
+        pages at a time, merged in order.  The list ends at the first short page.
+        A page bigger than asked for means the service does not support paging,
+        and has returned the whole list - as does a full page that repeats the
+        page before it, when the whole list is exactly one page long.
+        """
+        page_size = self.options.page_size
+        if not page_size:
+            return self.call_mahara(content)
+
+        result = []
+        offset = 0
+        last = None
+        while True:
+            offsets = [offset + i * page_size for i in range(max(1, self.options.fetch_threads))]
+            pages = self.fetch_pages(content, offsets, page_size)
+            for page in pages:
+                if len(page) > page_size or (page and page == last):
+                    logging.info(content['wsfunction'] + " does not support paging")
+                    return page
+                last = page
+                result.extend(page)
+                if len(page) < page_size:
+                    logging.debug(content['wsfunction'] + " fetched " + str(len(result)) + " in pages of " + str(page_size))
+                    return result
+            offset = offsets[-1] + page_size
+
+
+class BackgroundCall:
+    """
+    Run a function in its own thread from the start, so that independent
+    inputs - the IDE file and the remote users and groups - are gathered at
+    the same time.  result() waits for it, and raises anything it raised.
+    """
+    def __init__(self, function, *args):
+        self.function = function
+        self.args = args
+        self.value = None
+        self.error = None
+        self.elapsed = 0.0
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
+
+    def run(self):
+        started = time.time()
+        try:
+            self.value = self.function(*self.args)
+        except:
+            self.error = sys.exc_info()
+        self.elapsed = time.time() - started
+
+    def result(self):
+        self.thread.join()
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.value
+
+
+def get_csv_file(ide_file, policy=ide.duplicates.DEFAULT_POLICY):
+    """
+    Read the IDE records - one per person, as the duplicate policy decides.
+    """
+    duplicates = ide.duplicates.keyindex(policy)
+    records = ide.csvfile.read(ide_file, duplicates)
+    logging.info(duplicates.report())
+    return records
+
 
-def get_csv_file(ide_file):
-    return ide.csvfile.read(ide_file)
+def check_csv_file(ide_file):
+    """
+    Check the header of an IDE file, without parsing its records, so that an
+    empty or invalid file is found before the remote state is fetched.
+    Returns 'ok', 'empty' or 'invalid'.
+    """
+    fields, has_records = ide.csvfile.header(ide_file)
+    if not has_records:
+        logging.info('CSV file is empty')
+        return 'empty'
+    if not 'mlepSmsPersonId' in fields:
+        logging.error("CSV file has no mlepSmsPersonId field: " + ide_file)
+        return 'invalid'
+    return 'ok'
 
 
 def filter_by_remote_user(existing_users):
@@ -158,78 +380,101 @@ def filter_by_remote_user(existing_users):
     return result
 
 
-def main():
-
-    # setup logging
-    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s [%(name)s] %(levelname)s: %(message)s')
+def get_remote_users(mp):
+    """
+    Fetch the users of this institution - returns the set of all known
+    usernames, and the users keyed on their internal remote user.
+    """
+    parameters = {"wsfunction":"mahara_user_get_users"}
+    existing_users = mp.call_mahara_paged(parameters)
 
-    # setup command line args
-    parser = OptionParser()
-    parser.add_option("-f", "--file", dest="ide_file", default='ide.csv', type="string",
-                          help="The Identity Data Extract CSV file for input", metavar="IDE_FILE")
-    parser.add_option("-c", "--create", dest="create", action="store_true", default=False,
-                          help="Process creates", metavar="CREATES")
-    parser.add_option("-u", "--update", dest="update", action="store_true", default=False,
-                          help="Process updates", metavar="UPDATES")
-    parser.add_option("-d", "--delete", dest="delete", action="store_true", default=False,
-                          help="Process deletes", metavar="DELETES")
-    parser.add_option("-k", "--consumerkey", dest="consumer_key", default='', type="string",
-                          help="The OAuth Consumer Key for Mahara", metavar="CONSUMER_KEY")
-    parser.add_option("-n", "--domain", dest="school_domain", default='', type="string",
-                          help="The registered domain name of the school, typically used for email addresses, and/or Google Apps - hogwarts.school.nz", metavar="SCHOOL_DOMAIN")
-    parser.add_option("-p", "--password", dest="password", default=False, type="string",
-                          help="A default password for all new accounts", metavar="PASSWORD")
-    parser.add_option("-s", "--consumersecret", dest="consumer_secret", default='', type="string",
-                          help="The OAuth Consumer Secret for Mahara", metavar="CONSUMER_SECRET")
-    parser.add_option("-m", "--maharaurl", dest="mahara_url", default='http://mahara.local.net/maharadev', type="string",
-                          help="The base URL for Mahara - http://mahara.hogwarts.school.nz", metavar="MAHARA_URL")
-    parser.add_option("-g", "--groups", dest="groups", action="store_true", default=False,
-                          help="Process groups", metavar="GROUPS")
-    (options, args) = parser.parse_args()
+    # remember all the usernames that are known in this institution
+    usernames = set([user['username'].lower() for user in existing_users])
 
-    # load the csv file
-    logging.info("CSV file to process: " + str(options.ide_file))
-    logging.info("options are: " + str(options))
-    if not options.school_domain:
-        logging.error("You must specify the school domain.")
-        sys.exit(1)
+    # get a dictionary baked on the internal remote user for this institution context
+    existing_users = filter_by_remote_user(existing_users)
+    logging.debug('existing users: ' + repr(existing_users.keys()))
+    return usernames, existing_users
 
-    if not os.path.isfile(options.ide_file):
-        logging.error("CSV file not found: " + str(options.ide_file))
-        sys.exit(1)
-    sms_users = get_csv_file(options.ide_file)
 
-    if not sms_users or len(sms_users) == 0:
-        logging.info('CSV file is empty')
-        sys.exit(0)
+def get_remote_groups(mp):
+    """
+    Fetch the groups of this institution keyed on shortname.
+    """
+    parameters = {"wsfunction":"mahara_group_get_groups"}
+    existing_groups = mp.call_mahara_paged(parameters)
+    existing_groups = dict(zip([v['shortname'] for v in existing_groups], existing_groups))
+    logging.debug('Existing groups: ' + repr(existing_groups.keys()))
+    return existing_groups
 
 
-    # authenticate against Mahara
-    mp = MaharaProxy(options)
-    mp.authorise()
+def get_remote_state(mp):
+    """
+    Fetch the remote image that the change sets are calculated against -
+    the context, users and groups are independent, so are fetched at once.
+    """
+    users = BackgroundCall(get_remote_users, mp)
+    groups = BackgroundCall(get_remote_groups, mp)
 
     # determine the connected users context
     parameters = {"wsfunction":"mahara_user_get_context"}
     current_context = mp.call_mahara(parameters)
     logging.info("The institution context: " + current_context)
 
-    # process csv file:
-    #     - determine existing users
-    parameters = {"wsfunction":"mahara_user_get_users"}
-    existing_users = mp.call_mahara(parameters)
+    usernames, existing_users = users.result()
+    existing_groups = groups.result()
+    return {'context': current_context, 'usernames': usernames, 'users': existing_users, 'groups': existing_groups}
 
-    # remember all the usernames that are known in this institution
-    usernames = set([user['username'].lower() for user in existing_users])
 
-    # get a dictionary baked on the internal remote user for this institution context
-    existing_users = filter_by_remote_user(existing_users)
-    logging.debug('existing users: ' + repr(existing_users.keys()))
+def remote_fingerprint(remote):
+    """
+    A digest of the remote image that a plan was calculated against.  It is
+    taken over canonical stdlib JSON, so it does not depend on the JSON
+    backend of the run that made the plan.
+    """
+    def canonical(value):
+        return json.dumps(value, sort_keys=True, separators=(',', ':'))
+    digest = hashlib.sha1()
+    digest.update(canonical(remote['context']))
+    for key in sorted(remote['users'].keys()):
+        user = remote['users'][key]
+        digest.update(canonical([key] + [user.get(k) for k in USER_COMPARE_FIELDS]))
+    for name in sorted(remote['groups'].keys()):
+        members = sorted([(v['username'], v.get('role')) for v in remote['groups'][name]['members']])
+        digest.update(canonical([name, members]))
+    return digest.hexdigest()
+
+
+def make_plan(options, sms_users, remote, source, ide_snapshot=None):
+    """
+    Calculate the user and group change sets of the IDE records against the
+    remote image - the plan of the calls to make.  With --staging, the IDE
+    records are staged as a new snapshot, unless ide_snapshot is the id of
+    one already staged from them.
+    """
+    current_context = remote['context']
+    usernames = remote['usernames']
+    existing_users = remote['users']
+    existing_groups = remote['groups']
     sms_users = dict(zip([v['mlepSmsPersonId'].lower() for v in sms_users], sms_users))
 
     # compare the sets of user keys
-    create_users = list(set(sms_users.keys()).difference(set(existing_users.keys())))
-    update_users = list(set(sms_users.keys()).intersection(set(existing_users.keys())))
-    delete_users = list(set(existing_users.keys()).difference(set(sms_users.keys())))
+    if options.staging:
+        from ide import staging
+        if ide_snapshot is None:
+            store = staging.staging(options.staging)
+            ide_snapshot = store.load(sms_users.values(), source=source)
+            store.prune(options.keep_snapshots)
+        else:
+            store = staging.staging(options.staging, create=False)
+        remote_users = store.load_snapshot(persons=[(k, k, u.get('firstname', ''), u.get('lastname', ''), u.get('email', ''), '')
+                                                    for (k, u) in existing_users.iteritems()],
+                                           source=staging.REMOTE_SOURCE + 'users: ' + options.mahara_url)
+        create_users, update_users, delete_users = store.person_changes(remote_users, ide_snapshot)
+    else:
+        create_users = list(set(sms_users.keys()).difference(set(existing_users.keys())))
+        update_users = list(set(sms_users.keys()).intersection(set(existing_users.keys())))
+        delete_users = list(set(existing_users.keys()).difference(set(sms_users.keys())))
     logging.info("New users to process: " + str(len(create_users)))
     logging.info("Update users to process: " + str(len(update_users)))
     logging.info("Delete users to process: " + str(len(delete_users)))
@@ -239,13 +484,18 @@ def main():
 
     # process create users
     new_users = []
+    collisions = 0
     all_users = {} # need to collect all real user names
     for user in create_users:
         user = sms_users[user]
         username = user['mlepSmsPersonId'] + '@' + options.school_domain
         if username.lower() in usernames:
             logging.error("cannot create user - username already exists: " + username)
-            sys.exit(1)
+            if not options.skip_taken:
+                sys.exit(1)
+            # leave the account that holds it alone, and carry on
+            collisions += 1
+            continue
         all_users[user['mlepSmsPersonId'].lower()] = username # save new usernames
         if 'password' in user:
             new_password = user['password']
@@ -266,12 +516,8 @@ def main():
                           'remoteuser': user['mlepSmsPersonId'],
                         })
 
-    if options.create and new_users:
-        parameters = {"wsfunction":"mahara_user_create_users", "users": new_users}
-        result = mp.call_mahara(parameters)
-        logging.debug('Create users response: ' + repr(result))
-    else:
-        logging.info('create users skipped')
+    if collisions:
+        logging.warning("new users skipped as their usernames are taken: " + str(collisions))
 
     # process update users
     change_users = []
@@ -296,50 +542,39 @@ def main():
             update['username'] = user['username']
             change_users.append(update)
 
-    if options.update and change_users:
-        parameters = {"wsfunction":"mahara_user_update_users", "users": change_users}
-        result = mp.call_mahara(parameters)
-        logging.debug('Update users response: ' + repr(result))
-    else:
-        logging.info('update users skipped')
-
     # process delete users
     remove_users = []
     for user in delete_users:
         user = existing_users[user]
         remove_users.append({'username': user['username']})
 
-    if options.delete and remove_users:
-        parameters = {"wsfunction":"mahara_user_delete_users", "users": remove_users}
-        result = mp.call_mahara(parameters)
-        logging.debug('Delete users response: ' + repr(result))
+    if options.staging:
+        # the staged IDE snapshot already holds the groups and their members
+        groups = store.group_members(ide_snapshot)
+        remote_groups = store.load_snapshot(groups=existing_groups.keys(), source=staging.REMOTE_SOURCE + 'groups: ' + options.mahara_url)
+        create_groups, update_groups, delete_groups = store.group_changes(remote_groups, ide_snapshot)
+        if collisions:
+            # without the users that were skipped
+            groups = dict([(group, [user for user in members if user in all_users]) for (group, members) in groups.iteritems()])
+            create_groups = [group for group in create_groups if groups[group]]
+        # the remote images are only needed for this run
+        store.drop(remote_users)
+        store.drop(remote_groups)
+        store.close()
     else:
-        logging.info('delete users skipped')
-
-    # - determine existing groups
-    parameters = {"wsfunction":"mahara_group_get_groups"}
-    existing_groups = mp.call_mahara(parameters)
-    existing_groups = dict(zip([v['shortname'] for v in existing_groups], existing_groups))
-    logging.debug('Existing groups: ' + repr(existing_groups.keys()))
-
-    # find groups in SMS import - record users against groups
-    groups = {}
-    for user in all_users.keys():
-        attrs = sms_users[user]
-        user_groups = []
-        if 'mlepGroupMembership' in attrs and len(attrs['mlepGroupMembership']) > 0:
-            user_groups = [g.replace(' ', '_') for g in attrs['mlepGroupMembership'].split('#')]
-        if 'mlepRole' in attrs and len(attrs['mlepRole']) > 0:
-            user_groups.append(attrs['mlepRole'])
-        for group in user_groups:
-            if not group in groups:
-                groups[group] = []
-            groups[group].append(user)
-
-    # calculate group change sets
-    create_groups = list(set(groups.keys()).difference(set(existing_groups.keys())))
-    update_groups = list(set(groups.keys()).intersection(set(existing_groups.keys())))
-    delete_groups = list(set(existing_groups.keys()).difference(set(groups.keys())))
+        # find groups in SMS import - record users against groups
+        groups = {}
+        for user in all_users.keys():
+            user_groups, teacher = parse_record(sms_users[user])
+            for group in user_groups:
+                if not group in groups:
+                    groups[group] = []
+                groups[group].append(user)
+
+        # calculate group change sets
+        create_groups = list(set(groups.keys()).difference(set(existing_groups.keys())))
+        update_groups = list(set(groups.keys()).intersection(set(existing_groups.keys())))
+        delete_groups = list(set(existing_groups.keys()).difference(set(groups.keys())))
     logging.info("New groups to process: " + str(len(create_groups)))
     logging.info("Update groups to process: " + str(len(update_groups)))
     logging.info("Delete groups to process: " + str(len(delete_groups)))
@@ -358,9 +593,8 @@ def main():
         # do the members
         members = []
         for user in group_members:
-            account = sms_users[user]
             # teachers are 'tutor' students are members
-            if 'mlepRole' in account and re.match('Teach', account['mlepRole']):
+            if parse_record(sms_users[user])[1]:
                 role = 'tutor'
             else:
                 role = 'member'
@@ -380,19 +614,82 @@ def main():
             if user in sms_users:
                 account = sms_users[user]
                 # only remove ordinary members - not teachers
-                if 'mlepRole' in account and not re.match('Teach', account['mlepRole']):
+                if 'mlepRole' in account and not parse_record(account)[1]:
                     actions.append({'username': all_users[user], 'action': 'remove'})
         # do the add/update roles
         for user in groups[group['shortname']]:
-            account = sms_users[user]
             # teachers are 'tutor' students are members
-            if 'mlepRole' in account and re.match('Teach', account['mlepRole']):
+            if parse_record(sms_users[user])[1]:
                 role = 'tutor'
             else:
                 role = 'member'
             actions.append({'username': all_users[user], 'role': role, 'action': 'add'})
         group_updates.append({'shortname': group['shortname'], 'institution': group['institution'], 'members': actions})
-    
+
+    return {'version': PLAN_VERSION,
+            'created': int(time.time()),
+            'source': source,
+            'context': current_context,
+            'fingerprint': remote_fingerprint(remote),
+            'users': {'create': new_users, 'update': change_users, 'delete': remove_users},
+            'groups': {'create': group_creates, 'update': group_updates, 'delete': group_deletes}}
+
+
+def apply_plan(mp, options, plan, remote=None):
+    """
+    Make the calls of a plan - as far as the create, update, delete and
+    groups options allow.  A remote image is kept in step with the changes
+    applied, so that it can be reused for the next IDE file.
+    """
+    new_users = plan['users']['create']
+    change_users = plan['users']['update']
+    remove_users = plan['users']['delete']
+    group_creates = plan['groups']['create']
+    group_updates = plan['groups']['update']
+    group_deletes = plan['groups']['delete']
+
+    if options.create and new_users:
+        parameters = {"wsfunction":"mahara_user_create_users", "users": new_users}
+        result = mp.call_mahara(parameters)
+        logging.debug('Create users response: ' + repr(result))
+        # bring the remote image up to date
+        if remote:
+            for user in new_users:
+                current = dict(user)
+                del current['password']
+                current['auths'] = [{'auth': DEFAULT_AUTH, 'remoteuser': user['remoteuser']}]
+                remote['users'][user['remoteuser'].lower()] = current
+                remote['usernames'].add(user['username'].lower())
+    else:
+        logging.info('create users skipped')
+
+    if options.update and change_users:
+        parameters = {"wsfunction":"mahara_user_update_users", "users": change_users}
+        result = mp.call_mahara(parameters)
+        logging.debug('Update users response: ' + repr(result))
+        # bring the remote image up to date
+        if remote:
+            updated = dict([(v['username'], v) for v in change_users])
+            for current in remote['users'].values():
+                if current['username'] in updated:
+                    current.update(updated[current['username']])
+    else:
+        logging.info('update users skipped')
+
+    if options.delete and remove_users:
+        parameters = {"wsfunction":"mahara_user_delete_users", "users": remove_users}
+        result = mp.call_mahara(parameters)
+        logging.debug('Delete users response: ' + repr(result))
+        # bring the remote image up to date
+        if remote:
+            removed = set([v['username'] for v in remove_users])
+            for (key, current) in remote['users'].items():
+                if current['username'] in removed:
+                    remote['usernames'].discard(current['username'].lower())
+                    del remote['users'][key]
+    else:
+        logging.info('delete users skipped')
+
     # process the group change sets
     if options.groups:
         logging.info("processing groups")
@@ -401,21 +698,439 @@ def main():
             parameters = {"wsfunction":"mahara_group_create_groups", "groups": group_creates}
             result = mp.call_mahara(parameters)
             logging.debug('Create groups response: ' + repr(result))
+            if remote:
+                for group in group_creates:
+                    remote['groups'][group['shortname']] = {'shortname': group['shortname'], 'institution': group['institution'], 'members': group['members']}
 
         if group_updates:
             logging.info("processing group updates")
             parameters = {"wsfunction":"mahara_group_update_group_members", "groups": group_updates}
             result = mp.call_mahara(parameters)
             logging.debug('Update groups response: ' + repr(result))
+            if remote:
+                for group in group_updates:
+                    current = remote['groups'][group['shortname']]
+                    removed = set([v['username'] for v in group['members'] if v['action'] == 'remove'])
+                    added = dict([(v['username'], v['role']) for v in group['members'] if v['action'] == 'add'])
+                    members = [v for v in current['members'] if not v['username'] in removed and not v['username'] in added]
+                    current['members'] = members + [{'username': u, 'role': r} for (u, r) in added.iteritems()]
 
         if group_deletes:
             logging.info("processing group deletes")
             parameters = {"wsfunction":"mahara_group_delete_groups", "groups": group_deletes}
             result = mp.call_mahara(parameters)
             logging.debug('Delete groups response: ' + repr(result))
+            if remote:
+                for group in group_deletes:
+                    del remote['groups'][group['shortname']]
     else:
         logging.info('group processing skipped')
 
+    logging.info("web service traffic: " + mp.traffic_report())
+
+
+def synchronise(mp, options, sms_users, remote, source, ide_snapshot=None):
+    """
+    Calculate and apply the user and group change sets of the IDE records
+    against the remote image.
+    """
+    ide.profiling.phase('diff')
+    plan = make_plan(options, sms_users, remote, source, ide_snapshot)
+    ide.profiling.phase('apply')
+    apply_plan(mp, options, plan, remote)
+    logging.info(ide.membership.report())
+
+
+def write_plan_file(filename, plan):
+    """
+    Write a plan as gzipped JSON - readable only by the owner, as it holds
+    the passwords of new accounts.
+    """
+    length, body = encode_body(plan, compress=True)
+    # a new file, as the mode is only set on creation
+    if os.path.lexists(filename):
+        os.unlink(filename)
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+    f = os.fdopen(fd, 'wb')
+    f.write(body)
+    f.close()
+    logging.info("plan written to %s: %d bytes (%d uncompressed)" % (filename, len(body), length))
+
+
+def read_plan_file(filename):
+    """
+    Read a plan written by write_plan_file.
+    """
+    f = open(filename, 'rb')
+    data = zlib.decompress(f.read(), 16 + zlib.MAX_WBITS)
+    f.close()
+    plan = serializer.loads(data)
+    if plan.get('version') != PLAN_VERSION:
+        raise ValueError("unsupported plan version in " + filename)
+    return plan
+
+
+def check_plan(mp, options, plan):
+    """
+    Check that a plan still fits the remote Mahara - the institution context
+    must match, the plan must be no older than --maxage, and the remote
+    image is fetched to check the fingerprint.  With --noverify that fetch is
+    skipped, but then a plan must not delete anything.  Returns a list of
+    the problems found.
+    """
+    problems = []
+    parameters = {"wsfunction":"mahara_user_get_context"}
+    current_context = mp.call_mahara(parameters)
+    if current_context != plan['context']:
+        problems.append("plan is for institution " + plan['context'] + " not " + current_context)
+    age = time.time() - plan['created']
+    if options.max_age and age > options.max_age:
+        problems.append("plan is %d seconds old - older than %d" % (age, options.max_age))
+    if options.verify:
+        remote = get_remote_state(mp)
+        if remote_fingerprint(remote) != plan['fingerprint']:
+            problems.append("remote users or groups have changed since the plan was made")
+    else:
+        if options.delete and plan['users']['delete']:
+            problems.append("plan deletes users - it cannot be applied with --noverify")
+        if options.groups and plan['groups']['delete']:
+            problems.append("plan deletes groups - it cannot be applied with --noverify")
+    return problems
+
+
+def get_target(options, spec):
+    """
+    The options for one Mahara target of a multi-target run - the spec is
+    URL,CONSUMER_KEY,CONSUMER_SECRET[,TOKEN_FILE].  Without a token file,
+    each target gets its own one in the token directory, named for the URL.
+    """
+    parts = spec.split(',')
+    if len(parts) not in (3, 4):
+        raise ValueError("target must be URL,CONSUMER_KEY,CONSUMER_SECRET[,TOKEN_FILE]: " + spec)
+    target = copy.copy(options)
+    target.mahara_url, target.consumer_key, target.consumer_secret = parts[:3]
+    if len(parts) == 4:
+        target.token_file = parts[3]
+    else:
+        target.token_file = os.path.join(TOKEN_DIR, re.sub('[^\w.-]+', '_', target.mahara_url) + '.oauth')
+    return target
+
+
+def synchronise_targets(targets, records, source):
+    """
+    Run the fetch/diff/apply pipeline for the one set of IDE records against
+    every target concurrently, and report the timings of each.  Targets are
+    authorised one at a time first, as that may need the PIN to be entered.
+    records is the BackgroundCall reading the IDE file, which each target
+    only waits for once its own fetch is done.  With --staging, the records
+    are staged once, before the targets start, and each target only loads
+    its own remote image.  Returns True if every target succeeded.
+    """
+    proxies = []
+    for target in targets:
+        mp = MaharaProxy(target)
+        mp.authorise()
+        proxies.append(mp)
+
+    ide_snapshot = None
+    if targets[0].staging:
+        from ide import staging
+        try:
+            sms_users = records.result()
+            if sms_users:
+                store = staging.staging(targets[0].staging)
+                ide_snapshot = store.load(sms_users, source=source)
+                store.prune(targets[0].keep_snapshots)
+                store.close()
+        except:
+            logging.exception("cannot stage the IDE records: " + source)
+            return False
+
+    results = [None] * len(targets)
+    def run(i):
+        target, mp = targets[i], proxies[i]
+        started = time.time()
+        timing = {'fetch': 0.0, 'sync': 0.0, 'status': 'failed'}
+        try:
+            remote = get_remote_state(mp)
+            timing['fetch'] = time.time() - started
+            sms_users = records.result()
+            if sms_users:
+                synchronise(mp, target, sms_users, remote, source, ide_snapshot)
+            else:
+                logging.info('CSV file is empty')
+            timing['sync'] = time.time() - started - timing['fetch']
+            timing['status'] = 'ok'
+        except:
+            logging.exception("target failed: " + target.mahara_url)
+        timing['total'] = time.time() - started
+        results[i] = timing
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(targets))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    logging.info("target timings:")
+    for (target, timing) in zip(targets, results):
+        logging.info("  %s: %s - fetch %.2fs, sync %.2fs, total %.2fs" % (target.mahara_url, timing['status'], timing['fetch'], timing['sync'], timing['total']))
+    return not [timing for timing in results if timing['status'] != 'ok']
+
+
+def find_drop(options, polled):
+    """
+    Find the newest IDE file in the drop directory that has finished being
+    written - its size and mtime must be unchanged since the last poll, and
+    it must have been left alone for the settle period.  polled records the
+    (size, mtime) of each file seen on this poll for the next one.
+    """
+    newest = None
+    seen = {}
+    for name in os.listdir(options.watch):
+        if not fnmatch.fnmatch(name, options.pattern):
+            continue
+        path = os.path.join(options.watch, name)
+        if not os.path.isfile(path):
+            continue
+        st = os.stat(path)
+        seen[path] = (st.st_size, st.st_mtime)
+        if newest is None or st.st_mtime > seen[newest][1]:
+            newest = path
+    last = polled.copy()
+    polled.clear()
+    polled.update(seen)
+    if newest is None:
+        return None
+    # debounce partial writes
+    if last.get(newest) != seen[newest] or time.time() - seen[newest][1] < options.settle:
+        logging.debug("waiting for drop file to settle: " + newest)
+        return None
+    return newest
+
+
+def watch(mp, options):
+    """
+    Daemon mode - poll the drop directory, and synchronise each new IDE file
+    as it lands.  Every drop is a full extract, so only the newest file is
+    processed.  The remote image is kept warm between drops, and refreshed
+    from Mahara periodically, or after anything goes wrong.
+    """
+    logging.info("watching drop directory: " + str(options.watch))
+    remote = None
+    refreshed = 0
+    polled = {}
+    processed = None
+    # (path, size, mtime) of the last drop processed, or found unchanged -
+    # the same file left in place is not read again to be hashed
+    processed_stat = None
+    while True:
+        ide_file = find_drop(options, polled)
+        if ide_file and (ide_file,) + polled[ide_file] != processed_stat:
+            processed_stat = (ide_file,) + polled[ide_file]
+            f = open(ide_file, 'rb')
+            digest = hashlib.md5(f.read()).hexdigest()
+            f.close()
+            if digest != processed:
+                logging.info("CSV file to process: " + ide_file)
+                try:
+                    ide.profiling.phase('read')
+                    # an empty or invalid drop waits for the next one
+                    if check_csv_file(ide_file) == 'ok':
+                        # refresh the remote image while the drop is parsed
+                        fetch = None
+                        if remote is None or time.time() - refreshed > options.refresh:
+                            remote = None
+                            fetch = BackgroundCall(get_remote_state, mp)
+                        sms_users = get_csv_file(ide_file, options.duplicates)
+                        if fetch:
+                            remote = fetch.result()
+                            refreshed = time.time()
+                        synchronise(mp, options, sms_users, remote, ide_file)
+                    processed = digest
+                    logging.info("finished: " + ide_file)
+                except (Exception, SystemExit):
+                    # a bad drop, or a failed call that would end a one off
+                    # run, must not stop the daemon
+                    logging.exception("failed to process: " + ide_file)
+                    # the remote image may now be out of step
+                    remote = None
+                    processed_stat = None
+                ide.profiling.end()
+        time.sleep(options.interval)
+
+
+def main():
+
+    # setup logging
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s [%(name)s] %(levelname)s: %(message)s')
+
+    # setup command line args
+    parser = OptionParser()
+    parser.add_option("-f", "--file", dest="ide_file", default='ide.csv', type="string",
+                          help="The Identity Data Extract CSV file for input", metavar="IDE_FILE")
+    parser.add_option("-c", "--create", dest="create", action="store_true", default=False,
+                          help="Process creates", metavar="CREATES")
+    parser.add_option("-u", "--update", dest="update", action="store_true", default=False,
+                          help="Process updates", metavar="UPDATES")
+    parser.add_option("-d", "--delete", dest="delete", action="store_true", default=False,
+                          help="Process deletes", metavar="DELETES")
+    parser.add_option("-k", "--consumerkey", dest="consumer_key", default='', type="string",
+                          help="The OAuth Consumer Key for Mahara", metavar="CONSUMER_KEY")
+    parser.add_option("-n", "--domain", dest="school_domain", default='', type="string",
+                          help="The registered domain name of the school, typically used for email addresses, and/or Google Apps - hogwarts.school.nz", metavar="SCHOOL_DOMAIN")
+    parser.add_option("-p", "--password", dest="password", default=False, type="string",
+                          help="A default password for all new accounts", metavar="PASSWORD")
+    parser.add_option("-s", "--consumersecret", dest="consumer_secret", default='', type="string",
+                          help="The OAuth Consumer Secret for Mahara", metavar="CONSUMER_SECRET")
+    parser.add_option("-m", "--maharaurl", dest="mahara_url", default='http://mahara.local.net/maharadev', type="string",
+                          help="The base URL for Mahara - http://mahara.hogwarts.school.nz", metavar="MAHARA_URL")
+    parser.add_option("-g", "--groups", dest="groups", action="store_true", default=False,
+                          help="Process groups", metavar="GROUPS")
+    parser.add_option("-t", "--staging", dest="staging", default=False, type="string",
+                          help="SQLite staging database - keep IDE snapshots, and compute change sets in SQL", metavar="STAGING_DB")
+    parser.add_option("--keepsnapshots", dest="keep_snapshots", default=7, type="int",
+                          help="IDE snapshots kept in the staging database - older ones are pruned, 0 keeps them all", metavar="COUNT")
+    parser.add_option("--tokenfile", dest="token_file", default=TOKEN_FILE, type="string",
+                          help="File holding the OAuth access token for Mahara", metavar="TOKEN_FILE")
+    parser.add_option("--target", dest="targets", action="append", default=[], type="string",
+                          help="Synchronise to several Mahara instances concurrently - give once per instance as URL,CONSUMER_KEY,CONSUMER_SECRET[,TOKEN_FILE]", metavar="TARGET")
+    parser.add_option("--compressrequests", dest="compress_requests", default='auto', type="choice", choices=['auto', 'always', 'never'],
+                          help="gzip request bodies - auto does so once the server advertises Accept-Encoding: gzip", metavar="auto|always|never")
+    parser.add_option("--pagesize", dest="page_size", default=0, type="int",
+                          help="Fetch existing users and groups in pages of this many records - 0 fetches all at once", metavar="PAGE_SIZE")
+    parser.add_option("--fetchthreads", dest="fetch_threads", default=4, type="int",
+                          help="Number of pages of users and groups to fetch concurrently", metavar="FETCH_THREADS")
+    parser.add_option("-w", "--watch", dest="watch", default=False, type="string",
+                          help="Run as a daemon, watching a drop directory for new IDE files", metavar="DROP_DIR")
+    parser.add_option("--pattern", dest="pattern", default='*.csv', type="string",
+                          help="File name pattern of IDE files in the drop directory", metavar="PATTERN")
+    parser.add_option("--interval", dest="interval", default=30, type="int",
+                          help="Seconds between polls of the drop directory", metavar="SECONDS")
+    parser.add_option("--settle", dest="settle", default=10, type="int",
+                          help="Seconds a drop file must be left unchanged before it is processed", metavar="SECONDS")
+    parser.add_option("--refresh", dest="refresh", default=3600, type="int",
+                          help="Seconds after which the remote Mahara image is fetched afresh", metavar="SECONDS")
+    parser.add_option("--plan", dest="plan_file", default=False, type="string",
+                          help="Write the change plan to this file, and exit without applying it", metavar="PLAN_FILE")
+    parser.add_option("--apply", dest="apply_file", default=False, type="string",
+                          help="Apply a change plan written by --plan, without reading an IDE file", metavar="PLAN_FILE")
+    parser.add_option("--noverify", dest="verify", action="store_false", default=True,
+                          help="With --apply, skip fetching the remote users and groups to check they have not changed since the plan was made - refused for plans that delete")
+    parser.add_option("--maxage", dest="max_age", default=86400, type="int",
+                          help="With --apply, refuse plans older than this many seconds - 0 for no limit", metavar="SECONDS")
+    parser.add_option("--duplicates", dest="duplicates", default=ide.duplicates.DEFAULT_POLICY, type="choice", choices=ide.duplicates.POLICIES,
+                          help="Which record of a person repeated in the IDE file is used - first, last, or fail the run", metavar="first|last|fail")
+    parser.add_option("--skiptaken", dest="skip_taken", action="store_true", default=False,
+                          help="Skip new users whose username is already taken in Mahara, rather than stopping the run")
+    parser.add_option("--profile", dest="profile", default=False, type="string",
+                          help="Profile each phase of the run with cProfile (and tracemalloc where available) into this directory", metavar="PROFILE_DIR")
+    (options, args) = parser.parse_args()
+    ide.profiling.enable(options.profile)
+
+    logging.info("options are: " + str(options))
+    logging.info("JSON backend: " + serializer.BACKEND)
+
+    # apply a reviewed plan
+    if options.apply_file:
+        if options.watch or options.targets or options.plan_file:
+            logging.error("--apply cannot be combined with --watch, --target or --plan")
+            sys.exit(1)
+        ide.profiling.phase('read')
+        try:
+            plan = read_plan_file(options.apply_file)
+        except (IOError, ValueError, zlib.error), e:
+            logging.error("cannot read plan: " + str(e))
+            sys.exit(1)
+        logging.info("plan file to apply: %s (made from %s)" % (options.apply_file, plan['source']))
+        ide.profiling.phase('fetch')
+        mp = MaharaProxy(options)
+        mp.authorise()
+        problems = check_plan(mp, options, plan)
+        if problems:
+            for problem in problems:
+                logging.error("stale plan: " + problem)
+            sys.exit(1)
+        ide.profiling.phase('apply')
+        apply_plan(mp, options, plan)
+        sys.exit(0)
+
+    # load the csv file
+    logging.info("CSV file to process: " + str(options.ide_file))
+    if not options.school_domain:
+        logging.error("You must specify the school domain.")
+        sys.exit(1)
+
+    try:
+        targets = [get_target(options, spec) for spec in options.targets]
+    except ValueError, e:
+        logging.error(str(e))
+        sys.exit(1)
+
+    if options.plan_file and (options.watch or targets):
+        logging.error("--plan cannot be combined with --watch or --target")
+        sys.exit(1)
+
+    if options.watch:
+        if targets:
+            logging.error("multiple targets are not supported in watch mode")
+            sys.exit(1)
+        if not os.path.isdir(options.watch):
+            logging.error("drop directory not found: " + str(options.watch))
+            sys.exit(1)
+        mp = MaharaProxy(options)
+        mp.authorise()
+        watch(mp, options)
+
+    if not os.path.isfile(options.ide_file):
+        logging.error("CSV file not found: " + str(options.ide_file))
+        sys.exit(1)
+    status = check_csv_file(options.ide_file)
+    if status == 'empty':
+        sys.exit(0)
+    if status != 'ok':
+        sys.exit(1)
+
+    # the IDE read runs in its own thread, so is profiled on its own
+    read_csv_file = ide.profiling.profiled('read', get_csv_file)
+
+    # parse once, synchronise everywhere - the IDE file is parsed while the
+    # targets are authorised and fetched
+    if targets:
+        ide.profiling.phase('targets')
+        records = BackgroundCall(read_csv_file, options.ide_file, options.duplicates)
+        if not synchronise_targets(targets, records, options.ide_file):
+            sys.exit(1)
+        sys.exit(0)
+
+    # authenticate against Mahara, and fetch its users and groups while the
+    # IDE file is parsed
+    ide.profiling.phase('fetch')
+    records = BackgroundCall(read_csv_file, options.ide_file, options.duplicates)
+    mp = MaharaProxy(options)
+    mp.authorise()
+
+    remote = get_remote_state(mp)
+    try:
+        sms_users = records.result()
+    except ide.duplicates.DuplicateException, e:
+        logging.error(e.value)
+        sys.exit(1)
+    logging.info("IDE file parsed in %.2fs while fetching" % records.elapsed)
+
+    if not sms_users or len(sms_users) == 0:
+        logging.info('CSV file is empty')
+        sys.exit(0)
+
+    if options.plan_file:
+        ide.profiling.phase('diff')
+        plan = make_plan(options, sms_users, remote, options.ide_file)
+        ide.profiling.phase('write')
+        write_plan_file(options.plan_file, plan)
+        logging.info(ide.membership.report())
+        sys.exit(0)
+    synchronise(mp, options, sms_users, remote, options.ide_file)
+
     sys.exit(0)
 
 
@@ -20,6 +20,10 @@ Output files are:
  - mahara-groups.csv - group skeleton
  - mahara-groups-members.csv - members to add to groups
 
+The group files are written in shortname order.  The group memberships
+are held in memory up to --spill records, and beyond that are spilled to
+sorted temporary files that are merged as the group files are written.
+
 The IDE (Identity Data Extract) is a CSV file format that SMS vendors in 
 New Zealand generate to describe users for synchronisation to the school
 user directory.  This program extends the usefulness of this export format
@@ -46,20 +50,38 @@ Lesser General Public License for more details.
 """
 
 from __future__ import print_function
-import os, sys, re, time, random
+import os, sys
 import ide
+import ide.mapping
+import ide.membership
+import ide.profiling
+import ide.duplicates
+import ide.extsort
 import csv
 from optparse import OptionParser, SUPPRESS_HELP
 import logging
 
-def get_csv_file(ide_file):
-    return ide.csvfile.read(ide_file)
+def get_csv_file(ide_file, duplicates=None):
+    return ide.csvfile.read(ide_file, duplicates)
 
 def output_csv_file(filename, data):
     with open(filename, 'wb') as f:
         writer = csv.writer(f, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
         writer.writerows(data)
 
+def latest_memberships(memberships):
+    """
+    Drop all but the latest membership of a user in a group from the sorted
+    (group, username, record number, role) memberships.
+    """
+    last = None
+    for membership in memberships:
+        if last and last[:2] != membership[:2]:
+            yield last
+        last = membership
+    if last:
+        yield last
+
 USERS_FILE = 'mahara-users.csv'
 GROUPS_FILE = 'mahara-groups.csv'
 GROUPS_MEMBERS_FILE = 'mahara-groups-members.csv'
@@ -149,7 +171,18 @@ def main():
                           help="Process groups", metavar="GROUPS")
     parser.add_option("-a", "--admin", dest="admin", default=False, type="string",
                           help="The default admin user for all groups", metavar="ADMIN")
+    parser.add_option("--spill", dest="spill", default=ide.extsort.DEFAULT_LIMIT, type="int",
+                          help="Group memberships held in memory before spilling sorted runs to disk - 0 never spills", metavar="SPILL")
+    parser.add_option("-t", "--staging", dest="staging", default=False, type="string",
+                          help="SQLite staging database - keep IDE snapshots, and report changes since the last one", metavar="STAGING_DB")
+    parser.add_option("--keepsnapshots", dest="keep_snapshots", default=7, type="int",
+                          help="IDE snapshots kept in the staging database - older ones are pruned, 0 keeps them all", metavar="COUNT")
+    parser.add_option("--duplicates", dest="duplicates", default=ide.duplicates.DEFAULT_POLICY, type="choice", choices=ide.duplicates.POLICIES,
+                          help="Which record of a person repeated in the IDE file is output - first, last, or fail the run", metavar="first|last|fail")
+    parser.add_option("--profile", dest="profile", default=False, type="string",
+                          help="Profile each phase of the run with cProfile (and tracemalloc where available) into this directory", metavar="PROFILE_DIR")
     (options, args) = parser.parse_args()
+    ide.profiling.enable(options.profile)
 
     # load the csv file
     logging.info("CSV file to process: " + str(options.ide_file))
@@ -165,12 +198,26 @@ def main():
     if not os.path.isfile(options.ide_file):
         logging.error("CSV file not found: " + str(options.ide_file))
         sys.exit(1)
-    sms_users = get_csv_file(options.ide_file)
+    ide.profiling.phase('read')
+    duplicates = ide.duplicates.keyindex(options.duplicates)
+    try:
+        sms_users = get_csv_file(options.ide_file, duplicates)
+    except ide.duplicates.DuplicateException, e:
+        logging.error(e.value)
+        sys.exit(1)
+    logging.info(duplicates.report())
 
     if not sms_users or len(sms_users) == 0:
         logging.info('CSV file is empty')
         sys.exit(0)
 
+    if options.staging:
+        ide.profiling.phase('stage')
+        from ide import staging
+        store, previous, snapshot = staging.stage(options.staging, sms_users, options.ide_file, options.keep_snapshots)
+        store.close()
+
+    ide.profiling.phase('transform')
     # get a dictionary baked on the internal remote user for this institution context
     csv_attrs = dict(zip(sms_users[0].keys(), sms_users[0].keys()))
 
@@ -178,62 +225,68 @@ def main():
     if (options.genpassword or options.password or options.emptypassword) and not 'password' in csv_attrs:
         csv_attrs['password'] = 1
 
-    # determine the basic user fields for adding on
-    user_cols = [field for field in USER_FIELDS if FIELD_MAP[field] in csv_attrs]
+    # determine the basic user fields for adding on, and compile the mapping
+    user_plan = ide.mapping.plan(USER_FIELDS, FIELD_MAP, csv_attrs.keys(), ide.mapping.account_fields(options))
+    user_cols = user_plan.columns
+    project = user_plan.project
 
-    # loop through user records and accumulate users, and groups
-    groups = {}
+    # loop through user records and accumulate users, and group memberships
+    memberships = ide.extsort.sorter(options.spill)
     users = [user_cols]
     for user in sms_users:
         # construct the username
-        user['mlepUsername'] = user['mlepSmsPersonId'] + '@' + options.school_domain
+        username = user['mlepSmsPersonId'] + '@' + options.school_domain
         # process groups for this user
-        user_groups = []
-        if 'mlepGroupMembership' in user and len(user['mlepGroupMembership']) > 0:
-            user_groups = [g.replace(' ', '_') for g in user['mlepGroupMembership'].split('#')]
-        if 'mlepRole' in user and len(user['mlepRole']) > 0:
-            user_groups.append(user['mlepRole'])
-        if 'mlepRole' in user and re.match('Teach', user['mlepRole']):
+        user_groups, teacher = ide.membership.parse_record(user)
+        if teacher:
             role = 'tutor'
         else:
             role = 'member'
         for group in user_groups:
-            if not group in groups:
-                groups[group] = {}
-            groups[group][user['mlepUsername']] = role
-        # password is given, defaulted or generated
-        if options.genpassword:
-            user['password'] = 'pass' + str(random.random()) + str(int(time.time()))
-        if options.emptypassword:
-            user['password'] = ''
-        elif options.password:
-            user['password'] = options.password
+            # the record number lets the latest membership of a user win
+            memberships.add((group, username, len(users), role))
         # map only the fields given for the target CSV format
-        users.append([user[FIELD_MAP[field]] for field in user_cols])
+        users.append(project(user))
 
     logging.info("user records: " + str(len(users) - 1))
+    ide.profiling.phase('write')
 
     if options.users:
         logging.info("outputing user file")
         output_csv_file(USERS_FILE, users)
 
-    # now create the group file structures
-    csv_groups = [['shortname', 'displayname', 'description', 'roles', 'request']]
-    csv_group_members = [['shortname', 'username', 'role']]
-    for (group, members) in groups.iteritems():
-        csv_groups.append([group, group, group, 'course', 1])
-        csv_group_members.append([group, options.admin, 'admin'])
-        for (user, role) in members.iteritems():
-            csv_group_members.append([group, user, role])
-    
-    logging.info("group records: " + str(len(csv_groups) - 1))
-    logging.info("group member records: " + str(len(csv_group_members) - 1))
-
+    # now stream the group files out of the sorted memberships
+    group_count = 0
+    member_count = 0
     if options.groups:
         logging.info("outputing group files")
-        output_csv_file(GROUPS_FILE, csv_groups)
-        output_csv_file(GROUPS_MEMBERS_FILE, csv_group_members)
+        groups_file = open(GROUPS_FILE, 'wb')
+        members_file = open(GROUPS_MEMBERS_FILE, 'wb')
+        csv_groups = csv.writer(groups_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        csv_group_members = csv.writer(members_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        csv_groups.writerow(['shortname', 'displayname', 'description', 'roles', 'request'])
+        csv_group_members.writerow(['shortname', 'username', 'role'])
+    current = None
+    for (group, user, seq, role) in latest_memberships(memberships):
+        if group != current:
+            current = group
+            group_count += 1
+            member_count += 1
+            if options.groups:
+                csv_groups.writerow([group, group, group, 'course', 1])
+                csv_group_members.writerow([group, options.admin, 'admin'])
+        member_count += 1
+        if options.groups:
+            csv_group_members.writerow([group, user, role])
+    memberships.close()
+    if options.groups:
+        groups_file.close()
+        members_file.close()
+
+    logging.info("group records: " + str(group_count))
+    logging.info("group member records: " + str(member_count))
 
+    logging.info(ide.membership.report())
     logging.info("finished")
     sys.exit(0)
 
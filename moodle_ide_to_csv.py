@@ -21,6 +21,17 @@ Files output are:
  - moodle-users.csv - users, compatible with the standard Moodle bulk user upload tool
  - moodle-courses.csv - courses
 
+Differential output:
+
+  python moodle_ide_to_csv.py --file=ide.csv -u -c -e -a admin --state=moodle-state.json
+
+When a state file is given, the normalised users, enrolments and courses
+of the previous run are loaded from it, and only the changes are output:
+ - moodle-users-delta.csv - new/changed users (including changed enrolments),
+   and users that have gone from the IDE marked as deleted
+ - moodle-courses-delta.csv - newly appearing courses
+The state file is then rewritten with the current image.
+
 The moodle-course.csv file is compatible with a 3rd party tool
 for course upload:
   http://docs.moodle.org/20/en/Bulk_course_upload
@@ -49,22 +60,75 @@ Lesser General Public License for more details.
 """
 
 from __future__ import print_function
-import os, sys, re, time, random
+import os, sys
 import ide
+import ide.mapping
+import ide.membership
+import ide.profiling
+import ide.duplicates
 import csv
+import json
 from optparse import OptionParser, SUPPRESS_HELP
 import logging
 
-def get_csv_file(ide_file):
-    return ide.csvfile.read(ide_file)
+def get_csv_file(ide_file, duplicates=None):
+    return ide.csvfile.read(ide_file, duplicates)
 
 def output_csv_file(filename, data):
     with open(filename, 'wb') as f:
         writer = csv.writer(f, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
         writer.writerows(data)
 
+def utf8(value):
+    """
+    Convert the unicode that json hands back into the utf-8 strings the csv module uses.
+    """
+    if isinstance(value, dict):
+        return dict([(utf8(k), utf8(v)) for (k, v) in value.iteritems()])
+    if isinstance(value, list):
+        return [utf8(v) for v in value]
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+def read_state_file(filename):
+    """
+    Read the normalised state of the previous run - empty if there was none.
+    """
+    if not os.path.isfile(filename):
+        return {'users': {}, 'courses': []}
+    with open(filename, 'rb') as f:
+        return utf8(json.load(f))
+
+def write_state_file(filename, state):
+    """
+    Write the normalised state of this run, replacing the old one atomically.
+    """
+    tmp_file = filename + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        json.dump(state, f, sort_keys=True)
+    os.rename(tmp_file, filename)
+
+def computed_fields(options):
+    """
+    The IDE fields that are computed for each record rather than read from it -
+    the username and password shared with the other converters, and the
+    deleted flag.
+    """
+    computed = ide.mapping.account_fields(options)
+    # delete users
+    if options.delete:
+        computed['deleted'] = lambda user: '1'
+    return computed
+
 USERS_FILE = 'moodle-users.csv'
 COURSES_FILE = 'moodle-courses.csv'
+USERS_DELTA_FILE = 'moodle-users-delta.csv'
+COURSES_DELTA_FILE = 'moodle-courses-delta.csv'
+
+# fields that are not part of the normalised user state - passwords may be
+# generated afresh each run, and deleted is a processing instruction
+STATE_IGNORE_FIELDS = ['password', 'deleted']
 
 USER_FIELDS = [
     'username',
@@ -157,7 +221,18 @@ def main():
                           help="Process courses", metavar="COURSES")
     parser.add_option("-a", "--admin", dest="admin", default=False, type="string",
                           help="The default admin user for all groups", metavar="ADMIN")
+    parser.add_option("-t", "--staging", dest="staging", default=False, type="string",
+                          help="SQLite staging database - keep IDE snapshots, and report changes since the last one", metavar="STAGING_DB")
+    parser.add_option("--keepsnapshots", dest="keep_snapshots", default=7, type="int",
+                          help="IDE snapshots kept in the staging database - older ones are pruned, 0 keeps them all", metavar="COUNT")
+    parser.add_option("-s", "--state", dest="state_file", default=False, type="string",
+                          help="State file of the previous run - output only the changes since then", metavar="STATE_FILE")
+    parser.add_option("--duplicates", dest="duplicates", default=ide.duplicates.DEFAULT_POLICY, type="choice", choices=ide.duplicates.POLICIES,
+                          help="Which record of a person repeated in the IDE file is output - first, last, or fail the run", metavar="first|last|fail")
+    parser.add_option("--profile", dest="profile", default=False, type="string",
+                          help="Profile each phase of the run with cProfile (and tracemalloc where available) into this directory", metavar="PROFILE_DIR")
     (options, args) = parser.parse_args()
+    ide.profiling.enable(options.profile)
 
     # load the csv file
     logging.info("CSV file to process: " + str(options.ide_file))
@@ -173,12 +248,26 @@ def main():
     if not os.path.isfile(options.ide_file):
         logging.error("CSV file not found: " + str(options.ide_file))
         sys.exit(1)
-    sms_users = get_csv_file(options.ide_file)
+    ide.profiling.phase('read')
+    duplicates = ide.duplicates.keyindex(options.duplicates)
+    try:
+        sms_users = get_csv_file(options.ide_file, duplicates)
+    except ide.duplicates.DuplicateException, e:
+        logging.error(e.value)
+        sys.exit(1)
+    logging.info(duplicates.report())
 
     if not sms_users or len(sms_users) == 0:
         logging.info('CSV file is empty')
         sys.exit(0)
 
+    if options.staging:
+        ide.profiling.phase('stage')
+        from ide import staging
+        store, previous, snapshot = staging.stage(options.staging, sms_users, options.ide_file, options.keep_snapshots)
+        store.close()
+
+    ide.profiling.phase('transform')
     # get a dictionary baked on the internal remote user for this institution context
     csv_attrs = dict(zip(sms_users[0].keys(), sms_users[0].keys()))
 
@@ -190,42 +279,37 @@ def main():
     if options.delete and not 'deleted' in csv_attrs:
         csv_attrs['deleted'] = 1
 
-    # determine the basic user fields for adding on
-    user_cols = [field for field in USER_FIELDS if FIELD_MAP[field] in csv_attrs]
+    # determine the basic user fields for adding on, and compile the mapping
+    user_plan = ide.mapping.plan(USER_FIELDS, FIELD_MAP, csv_attrs.keys(), computed_fields(options))
+    user_cols = user_plan.columns
+    project = user_plan.project
 
     # loop through user records and accumulate users, and groups
     course_max = 0
     groups = {}
-    users = [user_cols]
+    users = [list(user_cols)]
+    state_users = {}
+    user_rows = {}
     for user in sms_users:
         # construct the username
-        user['mlepUsername'] = user['mlepSmsPersonId'] + '@' + options.school_domain
+        username = user['mlepSmsPersonId'] + '@' + options.school_domain
         # process groups for this user
-        user_groups = []
-        if 'mlepGroupMembership' in user and len(user['mlepGroupMembership']) > 0:
-            user_groups = [g.replace(' ', '_') for g in user['mlepGroupMembership'].split('#')]
-        if 'mlepRole' in user and len(user['mlepRole']) > 0:
-            user_groups.append(user['mlepRole'])
-        if 'mlepRole' in user and re.match('Teach', user['mlepRole']):
+        user_groups, teacher = ide.membership.parse_record(user)
+        if teacher:
             role = '2'
         else:
             role = '1'
         for group in user_groups:
             if not group in groups:
                 groups[group] = {}
-            groups[group][user['mlepUsername']] = role
-        # delete users
-        if options.delete:
-            user['deleted'] = '1'
-        # password is given, defaulted or generated
-        if options.genpassword:
-            user['password'] = 'pass' + str(random.random()) + str(int(time.time()))
-        if options.emptypassword:
-            user['password'] = ''
-        elif options.password:
-            user['password'] = options.password
+            groups[group][username] = role
         # map only the fields given for the target CSV format
-        row = [user[FIELD_MAP[field]] for field in user_cols]
+        row = project(user)
+        if options.state_file:
+            user_rows[username] = list(row)
+            state_users[username] = {
+                'fields': dict([(field, value) for (field, value) in zip(user_cols, row) if not field in STATE_IGNORE_FIELDS]),
+                'enrolments': [[group, role] for group in user_groups]}
         if options.enrol:
             if len(user_groups) > course_max:
                 course_max = len(user_groups)
@@ -245,8 +329,59 @@ def main():
 
 
     logging.info("user records: " + str(len(users) - 1))
-
-    if options.users:
+    ide.profiling.phase('write')
+
+    if options.state_file:
+        previous = read_state_file(options.state_file)
+        logging.info("previous state users: " + str(len(previous['users'])) + " courses: " + str(len(previous['courses'])))
+
+    if options.users and options.state_file:
+        # the delta always carries the username key, and the deleted flag
+        delta_cols = list(user_cols)
+        if not 'username' in delta_cols:
+            delta_cols.insert(0, 'username')
+        if not 'deleted' in delta_cols:
+            delta_cols.append('deleted')
+        # new and changed users - changed enrolments count as a change when enrolling
+        changed = []
+        for (username, current) in state_users.iteritems():
+            old = previous['users'].get(username)
+            if old and old['fields'] == current['fields'] and (not options.enrol or old['enrolments'] == current['enrolments']):
+                continue
+            changed.append((username, current))
+        # users gone from the IDE are marked deleted from their previous image
+        removed = [(username, old) for (username, old) in previous['users'].iteritems() if not username in state_users]
+        logging.info("changed user records: " + str(len(changed)) + " deleted user records: " + str(len(removed)))
+
+        delta_max = 0
+        delta_users = [delta_cols]
+        for (username, current) in sorted(changed):
+            fields = dict(zip(user_cols, user_rows[username]))
+            fields['username'] = username
+            row = [fields.get(field, '') for field in delta_cols]
+            if options.enrol:
+                if len(current['enrolments']) > delta_max:
+                    delta_max = len(current['enrolments'])
+                for (group, role) in current['enrolments']:
+                    row.append(group)
+                    row.append(role)
+            delta_users.append(row)
+        for (username, old) in sorted(removed):
+            fields = dict(old['fields'])
+            fields['username'] = username
+            fields['deleted'] = '1'
+            delta_users.append([fields.get(field, '') for field in delta_cols])
+        for i in range(1,delta_max+1):
+            delta_users[0].append('course'+str(i))
+            delta_users[0].append('type'+str(i))
+        line_max = len(delta_users[0])
+        for r in delta_users:
+            while len(r) < line_max:
+                r.append('')
+
+        logging.info("outputing user delta file")
+        output_csv_file(USERS_DELTA_FILE, delta_users)
+    elif options.users:
         logging.info("outputing user file")
         output_csv_file(USERS_FILE, users)
 
@@ -261,10 +396,28 @@ def main():
     
     logging.info("courses records: " + str(len(csv_courses) - 1))
 
-    if options.courses:
+    if options.courses and options.state_file:
+        known_courses = set(previous['courses'])
+        delta_courses = [csv_courses[0]] + [row for row in csv_courses[1:] if not row[0] in known_courses]
+        logging.info("new courses records: " + str(len(delta_courses) - 1))
+        logging.info("outputing courses delta file")
+        output_csv_file(COURSES_DELTA_FILE, delta_courses)
+    elif options.courses:
         logging.info("outputing courses files")
         output_csv_file(COURSES_FILE, csv_courses)
 
+    # record this image as the base for the next differential run - only
+    # the parts that were actually output move forward
+    if options.state_file:
+        state = {'users': previous['users'], 'courses': previous['courses']}
+        if options.users:
+            state['users'] = state_users
+        if options.courses:
+            state['courses'] = sorted(groups.keys())
+        write_state_file(options.state_file, state)
+        logging.info("state file updated: " + str(options.state_file))
+
+    logging.info(ide.membership.report())
     logging.info("finished")
     sys.exit(0)
 
@@ -0,0 +1,44 @@
+"""
+The external sort behind the --spill option of the Mahara converter
+
+  python -m unittest discover -s tests
+"""
+
+import os, sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from ide import extsort
+
+
+class SorterTest(unittest.TestCase):
+
+    def items(self, count):
+        return [('g%d' % random.randint(0, 50), 'u%d' % random.randint(0, 500), 'member') for i in range(count)]
+
+    def test_in_memory(self):
+        items = self.items(100)
+        memberships = extsort.sorter(limit=0)
+        for item in items:
+            memberships.add(item)
+        self.assertEqual(memberships.runs, [])
+        self.assertEqual(list(memberships), sorted(items))
+        memberships.close()
+
+    def test_open_runs_bounded(self):
+        # a spill of every item would otherwise hold a file open per item
+        items = self.items(extsort.MERGE_WIDTH ** 3)
+        memberships = extsort.sorter(limit=1)
+        most = 0
+        for item in items:
+            memberships.add(item)
+            most = max(most, len(memberships.runs))
+        self.assertTrue(most < 3 * extsort.MERGE_WIDTH, most)
+        self.assertEqual(len(memberships), len(items))
+        self.assertEqual(list(memberships), sorted(items))
+        memberships.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+"""
+Paged fetches of mahara_ide_importer against a stub web service
+
+  python -m unittest discover -s tests
+
+The stub serves a list of records to every call, honouring offset/limit
+only when it is told to page, as older web service plugins do not.
+"""
+
+import os, sys
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+import BaseHTTPServer, SocketServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import mahara_ide_importer
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['content-length'])))
+        server = self.server
+        server.calls += 1
+        records = server.records
+        if server.paged and 'limit' in request:
+            records = records[request['offset']:request['offset'] + request['limit']]
+        data = json.dumps(records)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class Options(object):
+    consumer_key = 'key'
+    consumer_secret = 'secret'
+    compress_requests = 'never'
+    fetch_threads = 2
+
+
+class PagingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer(('127.0.0.1', 0), StubHandler)
+        self.server.calls = 0
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.tmpdir = tempfile.mkdtemp()
+        self.options = Options()
+        self.options.mahara_url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.options.token_file = os.path.join(self.tmpdir, 'mahara.oauth')
+        mahara_ide_importer.write_token_file(self.options.token_file, 'token', 'secret')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def fetch(self, count, page_size, paged):
+        self.server.records = [{'shortname': 'group%d' % i} for i in range(count)]
+        self.server.paged = paged
+        self.options.page_size = page_size
+        mp = mahara_ide_importer.MaharaProxy(self.options)
+        return mp.call_mahara_paged({'wsfunction': 'mahara_group_get_groups'})
+
+    def test_unpaged_list_of_one_page(self):
+        for fetch_threads in (1, 2):
+            self.options.fetch_threads = fetch_threads
+            self.server.calls = 0
+            self.assertEqual(self.fetch(1, 1, False), self.server.records)
+            self.assertTrue(self.server.calls <= 2)
+            self.assertEqual(self.fetch(3, 3, False), self.server.records)
+
+    def test_unpaged_list_bigger_than_a_page(self):
+        self.assertEqual(self.fetch(5, 2, False), self.server.records)
+
+    def test_paged(self):
+        for count in (0, 1, 4, 5):
+            self.assertEqual(self.fetch(count, 2, True), self.server.records)
+
+
+if __name__ == "__main__":
+    unittest.main()
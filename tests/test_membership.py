@@ -0,0 +1,60 @@
+"""
+The membership cache shared by the threads of a multi-target run
+
+  python -m unittest discover -s tests
+"""
+
+import os, sys
+import random
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from ide import membership
+
+
+class LruCacheTest(unittest.TestCase):
+
+    def test_eviction(self):
+        cache = membership.lrucache(lambda membership, role: (membership, role), maxsize=2)
+        cache('a', 'r')
+        cache('b', 'r')
+        cache('a', 'r')
+        cache('c', 'r')
+        self.assertEqual(sorted(cache.map.keys()), [('a', 'r'), ('c', 'r')])
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+    def test_threads(self):
+        cache = membership.lrucache(lambda membership, role: (membership, role), maxsize=16)
+        errors = []
+        def run():
+            try:
+                for i in range(20000):
+                    key = str(random.randint(0, 50))
+                    if cache(key, 'r') != (key, 'r'):
+                        errors.append(key)
+            except Exception, e:
+                errors.append(e)
+        interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        try:
+            threads = [threading.Thread(target=run) for i in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            sys.setcheckinterval(interval)
+        self.assertEqual(errors, [])
+        # the list holds exactly the cached entries
+        count = 0
+        link = cache.root[1]
+        while link is not cache.root:
+            count += 1
+            link = link[1]
+        self.assertEqual(count, len(cache.map))
+        self.assertTrue(len(cache.map) <= 16)
+
+
+if __name__ == "__main__":
+    unittest.main()
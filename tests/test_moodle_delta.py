@@ -0,0 +1,115 @@
+"""
+Differential Moodle output - two runs over small extracts sharing a state
+file, as a nightly job would make them
+
+  python -m unittest discover -s tests
+"""
+
+import os, sys
+import csv
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+CONVERTER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'moodle_ide_to_csv.py')
+
+HEADER = 'mlepSmsPersonId,mlepFirstName,mlepLastName,mlepEmail,mlepRole,mlepGroupMembership\n'
+
+FIRST = HEADER + """1001,Harry,Potter,harry@h.nz,Student,9A#Maths
+1002,Hermione,Granger,herm@h.nz,Student,9A#Science
+1003,Severus,Snape,snape@h.nz,TeachingStaff,Maths
+"""
+
+# Harry changes his name, Hermione leaves, Luna arrives in a new course
+SECOND = HEADER + """1001,Harold,Potter,harry@h.nz,Student,9A#Maths
+1003,Severus,Snape,snape@h.nz,TeachingStaff,Maths
+1004,Luna,Lovegood,luna@h.nz,Student,9A#Art
+"""
+
+
+class MoodleDeltaTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def run_converter(self, extract, *args):
+        ide_file = os.path.join(self.tmpdir, 'ide.csv')
+        f = open(ide_file, 'wb')
+        f.write(extract)
+        f.close()
+        for name in os.listdir(self.tmpdir):
+            if name.endswith('-delta.csv'):
+                os.remove(os.path.join(self.tmpdir, name))
+        devnull = open(os.devnull, 'w')
+        try:
+            status = subprocess.call([sys.executable, CONVERTER, '-f', ide_file, '-n', 'h.nz', '-a', 'admin', '-s', 'state.json'] + list(args),
+                                     stdout=devnull, stderr=devnull, cwd=self.tmpdir)
+        finally:
+            devnull.close()
+        self.assertEqual(status, 0)
+
+    def read_output(self, name):
+        filename = os.path.join(self.tmpdir, name)
+        if not os.path.isfile(filename):
+            return None
+        f = open(filename, 'rb')
+        rows = list(csv.reader(f))
+        f.close()
+        return [dict(zip(rows[0], row)) for row in rows[1:]]
+
+    def users(self):
+        rows = self.read_output('moodle-users-delta.csv')
+        return dict([(row['username'], row) for row in rows])
+
+    def courses(self):
+        return sorted([row['shortname'] for row in self.read_output('moodle-courses-delta.csv')])
+
+    def test_changes(self):
+        self.run_converter(FIRST, '-u', '-c', '-e')
+        self.assertEqual(sorted(self.users().keys()), ['1001@h.nz', '1002@h.nz', '1003@h.nz'])
+        self.assertEqual(self.courses(), ['9A', 'Maths', 'Science', 'Student', 'TeachingStaff'])
+
+        self.run_converter(SECOND, '-u', '-c', '-e')
+        users = self.users()
+        self.assertEqual(sorted(users.keys()), ['1001@h.nz', '1002@h.nz', '1004@h.nz'])
+        # changed
+        self.assertEqual(users['1001@h.nz']['firstname'], 'Harold')
+        self.assertEqual(users['1001@h.nz']['deleted'], '')
+        # gone - from the image of the previous run
+        self.assertEqual(users['1002@h.nz']['deleted'], '1')
+        self.assertEqual(users['1002@h.nz']['firstname'], 'Hermione')
+        # new, with its enrolments padded out to the widest row
+        self.assertEqual((users['1004@h.nz']['course1'], users['1004@h.nz']['course2'], users['1004@h.nz']['course3']),
+                         ('9A', 'Art', 'Student'))
+        self.assertEqual(users['1002@h.nz']['course1'], '')
+        self.assertEqual(self.courses(), ['Art'])
+
+    def test_unchanged(self):
+        self.run_converter(FIRST, '-u', '-c', '-e')
+        self.run_converter(FIRST, '-u', '-c', '-e')
+        self.assertEqual(self.users(), {})
+        self.assertEqual(self.courses(), [])
+
+    def test_users_only_moves_users_forward(self):
+        self.run_converter(FIRST, '-u')
+        self.assertEqual(self.read_output('moodle-courses-delta.csv'), None)
+        # the courses were never output, so are all still new
+        self.run_converter(SECOND, '-u', '-c')
+        self.assertEqual(sorted(self.users().keys()), ['1001@h.nz', '1002@h.nz', '1004@h.nz'])
+        self.assertEqual(self.courses(), ['9A', 'Art', 'Maths', 'Student', 'TeachingStaff'])
+
+    def test_courses_only_moves_courses_forward(self):
+        self.run_converter(FIRST, '-c')
+        self.assertEqual(self.read_output('moodle-users-delta.csv'), None)
+        # the users were never output, so are all still new
+        self.run_converter(SECOND, '-u', '-c')
+        self.assertEqual(sorted(self.users().keys()), ['1001@h.nz', '1003@h.nz', '1004@h.nz'])
+        self.assertEqual(self.courses(), ['Art'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+"""
+Snapshot lookup and retention in the SQLite staging store
+
+  python -m unittest discover -s tests
+"""
+
+import os, sys
+import shutil
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from ide import staging
+
+
+def record(person, groups=''):
+    return {'mlepSmsPersonId': person, 'mlepFirstName': 'F', 'mlepLastName': 'L', 'mlepEmail': '',
+            'mlepRole': 'Student', 'mlepGroupMembership': groups}
+
+
+class StagingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = staging.staging()
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_latest_ide_snapshot_whatever_the_file(self):
+        self.assertEqual(self.store.latest_ide_snapshot(), None)
+        first = self.store.load([record('1')], source='ide-20261017.csv')
+        self.store.load_snapshot(persons=[('1', '1', '', '', '', '')], source=staging.REMOTE_SOURCE + 'users: http://m')
+        self.assertEqual(self.store.latest_ide_snapshot(), first)
+        second = self.store.load([record('1'), record('2')], source='ide-20261018.csv')
+        self.assertEqual(self.store.latest_ide_snapshot(), second)
+        self.assertEqual(self.store.person_changes(first, second), (['2'], ['1'], []))
+
+    def test_prune(self):
+        snapshots = [self.store.load([record(str(i), '9A')], source='ide.csv') for i in range(4)]
+        remote = self.store.load_snapshot(groups=['9A'], source=staging.REMOTE_SOURCE + 'groups: http://m')
+        self.assertEqual(self.store.prune(0), 0)
+        self.assertEqual(self.store.prune(2), 2)
+        self.assertEqual([row[0] for row in self.store.snapshots()], snapshots[2:] + [remote])
+        self.assertEqual(self.store.group_members(snapshots[0]), {})
+        self.assertEqual(self.store.group_members(snapshots[3]), {'9A': ['3'], 'Student': ['3']})
+
+    def test_concurrent_writers(self):
+        # as each target of a multi-target run loads its remote images
+        directory = tempfile.mkdtemp()
+        try:
+            db_file = os.path.join(directory, 'staging.db')
+            staging.staging(db_file).close()
+            errors = []
+            def load(url):
+                try:
+                    store = staging.staging(db_file, create=False)
+                    for i in range(20):
+                        store.drop(store.load_snapshot(persons=[('1', '1', '', '', '', '')], source=staging.REMOTE_SOURCE + 'users: ' + url))
+                    store.close()
+                except Exception, e:
+                    errors.append(e)
+            threads = [threading.Thread(target=load, args=('http://m%d' % i,)) for i in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(errors, [])
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    unittest.main()